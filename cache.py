@@ -0,0 +1,368 @@
+# cache.py
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Optional, Set, Tuple, Union, BinaryIO
+
+import numpy as np
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import model
+from util import embed_text, GEMINI_MODEL_NAME, PROMPT_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Minimum cosine similarity for a near-duplicate document to reuse a cached result
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# Seconds between loads of embeddings stored by other workers into the in-memory index
+SEMANTIC_CACHE_REFRESH_INTERVAL = float(os.getenv("SEMANTIC_CACHE_REFRESH_INTERVAL", "30"))
+# The index grows by at least this many rows at a time instead of copying on every insert
+SEMANTIC_CACHE_BLOCK_SIZE = 1024
+
+# Size and lifetime of the in-process cache of serialized document responses
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "1024"))
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "300"))
+# Total size of the cached response bodies; bodies include the full extracted text
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Lifetime of the cached document statistics
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))
+
+# Cached analyses are only valid for the model and prompts that produced them
+ANALYSIS_VERSION = f"{GEMINI_MODEL_NAME}:{PROMPT_VERSION}"
+
+# Files are hashed in chunks of this size so large uploads are never fully loaded
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_text(text: str) -> str:
+    """Return the SHA-256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(file_content: Union[bytes, BinaryIO]) -> str:
+    """Return the SHA-256 hex digest of file bytes or a seekable file, which is rewound afterwards."""
+    if isinstance(file_content, bytes):
+        return hashlib.sha256(file_content).hexdigest()
+
+    digest = hashlib.sha256()
+    file_content.seek(0)
+    while chunk := file_content.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file_content.seek(0)
+    return digest.hexdigest()
+
+
+def analysis_key(content_hash: str) -> str:
+    """Return the cache key of a content hash for the current ANALYSIS_VERSION."""
+    return hash_text(f"{ANALYSIS_VERSION}:{content_hash}")
+
+
+def document_cache_key(content_sha256: str, file_type: str) -> str:
+    """Return the document cache key of a file; its type decides how the bytes are extracted."""
+    return analysis_key(f"{content_sha256}:{file_type}")
+
+
+def lookup_document_cache(db: Session, content_sha256: str, file_type: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached extraction and analysis of a previously processed file, or None.
+
+    The result has the same shape as analyze_document plus the "extracted_text".
+    Entries stored under an earlier model or prompt version are not returned.
+    """
+    entry = db.query(model.DocumentCache).filter(
+        model.DocumentCache.cache_key == document_cache_key(content_sha256, file_type)
+    ).first()
+    if entry is None:
+        return None
+
+    return {
+        "extracted_text": entry.extracted_text,
+        "structured_data": dict(entry.extracted_data),
+        "categorization": {
+            "primary_category": entry.primary_category,
+            "financial_type": entry.financial_type,
+            "confidence": entry.confidence,
+            "reasoning": entry.reasoning
+        },
+        "summary": entry.summary
+    }
+
+
+def store_document_cache(
+        db: Session,
+        content_sha256: str,
+        file_type: str,
+        extracted_text: str,
+        analysis: Dict[str, Any],
+        summary: str
+) -> None:
+    """Cache the extraction and a successful analysis of a file under its content hash."""
+    structured_data = analysis["structured_data"]
+    categorization = analysis["categorization"]
+
+    # Never cache failed Gemini calls
+    if "error" in structured_data or categorization.get("primary_category") in ("ERROR", "UNKNOWN"):
+        return
+    if summary == "Error generating summary.":
+        return
+
+    try:
+        # A concurrent upload of the same file may have stored it already
+        db.execute(
+            insert(model.DocumentCache).values(
+                cache_key=document_cache_key(content_sha256, file_type),
+                extracted_text=extracted_text,
+                extracted_data=structured_data,
+                summary=summary,
+                primary_category=categorization.get("primary_category", "UNKNOWN"),
+                financial_type=categorization.get("financial_type", "NEUTRAL"),
+                confidence=float(categorization.get("confidence", 0)),
+                reasoning=categorization.get("reasoning", "")
+            ).on_conflict_do_nothing(index_elements=[model.DocumentCache.cache_key])
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Could not store document cache entry: {e}")
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a fixed size and per-entry TTL.
+
+    The TTL bounds how long an entry can go stale in processes that didn't see
+    the invalidation, e.g. other Uvicorn workers. When max_bytes is given, the
+    cache also keeps the total sizeof() of its values under it; values larger
+    than max_bytes on their own are not cached.
+    """
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float,
+            max_bytes: Optional[int] = None,
+            sizeof: Callable[[Any], int] = lambda value: 0
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Any, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+
+    def _pop(self, key: Any) -> None:
+        """Remove key, which must be present, and release its size. Call with the lock held."""
+        self._bytes -= self._entries.pop(key)[2]
+
+    def get(self, key: Any) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value, _ = item
+            if expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        """Cache value under key, evicting the least recently used entries when full."""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.maxsize or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key: Any) -> None:
+        """Remove key from the cache if present."""
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+
+class SemanticCache:
+    """
+    Cache of Gemini extraction and categorization results keyed by document text.
+
+    Identical texts are found by their SHA-256 hash. Near-duplicates are found by
+    cosine similarity of their embeddings against an in-memory index, which is
+    loaded from the llm_cache table on first use and then topped up every
+    SEMANTIC_CACHE_REFRESH_INTERVAL seconds with entries stored by other processes.
+    Entries from an earlier model or prompt version are ignored. Only the
+    categorization of a near-duplicate is reused: the embedding covers just the
+    start of a document, so its extracted fields (amounts, dates, identifiers)
+    may well differ.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._synced_at: Optional[float] = None
+        self._max_synced_id = 0
+        self._ids: List[int] = []
+        self._known_ids: Set[int] = set()
+        # Rows beyond len(self._ids) are preallocated space for future entries
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    def _sync(self, db: Session) -> None:
+        """Load embeddings stored since the last sync, by this or any other process."""
+        with self._lock:
+            if self._synced_at is not None and time.monotonic() - self._synced_at < SEMANTIC_CACHE_REFRESH_INTERVAL:
+                return
+            # Claim this sync so concurrent lookups don't repeat it
+            self._synced_at = time.monotonic()
+            after_id = self._max_synced_id
+
+        rows = db.query(model.LLMCache.id, model.LLMCache.embedding).filter(
+            model.LLMCache.id > after_id,
+            model.LLMCache.embedding.isnot(None),
+            model.LLMCache.analysis_version == ANALYSIS_VERSION
+        ).order_by(model.LLMCache.id).all()
+        if not rows:
+            return
+
+        with self._lock:
+            for row in rows:
+                self._append(row.id, np.asarray(row.embedding, dtype=np.float32))
+            self._max_synced_id = max(self._max_synced_id, rows[-1].id)
+        logger.info(f"Semantic cache loaded {len(rows)} entries, {len(self._ids)} in total")
+
+    def _append(self, entry_id: int, vector: np.ndarray) -> None:
+        """Add a normalized embedding to the index, growing it in blocks. Call with the lock held."""
+        if entry_id in self._known_ids:
+            return
+
+        size = len(self._ids)
+        if size == self._matrix.shape[0]:
+            grown = np.empty((max(SEMANTIC_CACHE_BLOCK_SIZE, size * 2), vector.shape[0]), dtype=np.float32)
+            grown[:size] = self._matrix[:size]
+            self._matrix = grown
+        self._matrix[size] = vector
+        self._ids.append(entry_id)
+        self._known_ids.add(entry_id)
+
+    def _search(self, vector: np.ndarray) -> Tuple[Optional[int], float]:
+        """Return the ID and similarity of the closest cached embedding."""
+        with self._lock:
+            if not self._ids:
+                return None, 0.0
+            scores = self._matrix[:len(self._ids)] @ vector
+            best = int(np.argmax(scores))
+            return self._ids[best], float(scores[best])
+
+    def _add(self, entry_id: int, vector: np.ndarray) -> None:
+        """Add a normalized embedding stored by this process to the in-memory index."""
+        with self._lock:
+            self._append(entry_id, vector)
+
+    @staticmethod
+    def _to_result(entry: model.LLMCache, exact: bool) -> Dict[str, Any]:
+        """
+        Rebuild the analyze_document categorization, and for an exact text match
+        the structured data, from a cache entry.
+        """
+        result = {"categorization": dict(entry.categorization)}
+        if exact and entry.structured_data:
+            result["structured_data"] = dict(entry.structured_data)
+        return result
+
+    def lookup(
+            self,
+            db: Session,
+            text: str,
+            similar: bool = True
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[np.ndarray]]:
+        """
+        Look up a cached analysis for the given text.
+
+        Returns the cached result (or None on a miss) and the text's normalized
+        embedding, so a subsequent store() doesn't need to embed it again. The
+        result always has a "categorization"; it only has "structured_data" when
+        the identical text was analyzed before. With similar=False only identical
+        texts are looked up, which needs no embedding call.
+        """
+        # Exact match fast path, no embedding call needed
+        entry = db.query(model.LLMCache).filter(
+            model.LLMCache.content_hash == analysis_key(hash_text(text))
+        ).first()
+        if entry:
+            return self._to_result(entry, exact=True), None
+        if not similar:
+            return None, None
+
+        self._sync(db)
+
+        try:
+            vector = np.asarray(embed_text(text), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        except Exception as e:
+            logger.error(f"Error embedding text for semantic cache: {e}")
+            return None, None
+
+        entry_id, similarity = self._search(vector)
+        if entry_id is not None and similarity >= self.threshold:
+            entry = db.query(model.LLMCache).filter(model.LLMCache.id == entry_id).first()
+            if entry:
+                logger.info(f"Semantic cache hit (similarity {similarity:.3f})")
+                return self._to_result(entry, exact=False), vector
+
+        return None, vector
+
+    def store(self, db: Session, text: str, vector: Optional[np.ndarray], result: Dict[str, Any]) -> None:
+        """Store a successful analyze_document result for the given text."""
+        structured_data = result["structured_data"]
+        categorization = result["categorization"]
+
+        # Never cache failed Gemini calls
+        if "error" in structured_data or categorization.get("primary_category") in ("ERROR", "UNKNOWN"):
+            return
+
+        try:
+            entry = model.LLMCache(
+                content_hash=analysis_key(hash_text(text)),
+                analysis_version=ANALYSIS_VERSION,
+                embedding=vector.tolist() if vector is not None else None,
+                structured_data=structured_data,
+                categorization=categorization
+            )
+            db.add(entry)
+            db.commit()
+        except Exception as e:
+            # Most likely a concurrent insert of the same text
+            db.rollback()
+            logger.warning(f"Could not store semantic cache entry: {e}")
+            return
+
+        if vector is not None:
+            self._add(entry.id, vector)
+
+
+semantic_cache = SemanticCache()
+
+# ETags and serialized GET /documents/{id} responses, keyed by document ID
+document_response_cache = LRUCache(
+    DOCUMENT_CACHE_SIZE,
+    DOCUMENT_CACHE_TTL,
+    max_bytes=DOCUMENT_CACHE_MAX_BYTES,
+    sizeof=lambda item: len(item[1])
+)
+
+# Aggregated statistics, keyed by endpoint
+stats_cache = LRUCache(8, STATS_CACHE_TTL)
@@ -2,38 +2,180 @@
 
 import os
 import json
+import hashlib
+import shutil
+import tempfile
 import uuid
 import time
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, status, Query, BackgroundTasks
-from fastapi.responses import JSONResponse
+import orjson
+from pydantic import TypeAdapter
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, status, Query, BackgroundTasks, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import func, insert, select, update, delete, tuple_
+from sqlalchemy.orm import Session, undefer, joinedload
+from typing import List, Optional, Union, BinaryIO, Tuple
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-from database import get_db, engine, Base
+from database import get_db, engine, Base, SessionLocal
 import model
 import schema
+from cache import (
+    semantic_cache,
+    document_response_cache,
+    stats_cache,
+    hash_file,
+    lookup_document_cache,
+    store_document_cache
+)
 from util import (
-    extract_text_from_file,
-    extract_structured_data,
+    extract_text_from_file_async,
+    shutdown_extraction_pool,
     categorize_document,
-    validate_file_extension,
+    analyze_document_batcher,
     get_supported_file_extensions,
     summarize_document,
     process_batch_documents,
+    get_gemini_client,
     SUPPORTED_EXTENSIONS,
 )
 
 # Create tables
 Base.metadata.create_all(bind=engine)
 
+# Uploads are copied in chunks of this size; anything above the spool size spills to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Upload size limits; the request body may exceed the file sizes by the multipart envelope
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(250 * 1024 * 1024)))
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_TOO_LARGE_DETAIL = f"File too large. Maximum upload size is {MAX_UPLOAD_BYTES} bytes"
+
+# Validation error details are built once instead of on every rejected request
+SUPPORTED_FORMATS_TEXT = ", ".join(SUPPORTED_EXTENSIONS)
+INVALID_FILE_TYPE_DETAIL = f"Invalid file type. Supported types: {SUPPORTED_FORMATS_TEXT}"
+
+# Number of batch files processed concurrently
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "5"))
+
+# Batch files are saved here until processed; must be shared storage when workers run on other hosts
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+
+# Seconds between database pool status log lines (0 disables them)
+DB_POOL_LOG_INTERVAL = float(os.getenv("DB_POOL_LOG_INTERVAL", "0"))
+
+# Batch progress is written after this many analyzed files or seconds, whichever comes first
+BATCH_PROGRESS_EVERY = 10
+BATCH_PROGRESS_INTERVAL = 1.0
+
+# Batches are queued for worker.py through arq when set, otherwise processed in-process
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Upper bound on the extracted_data JSON sent for categorization when a document has no extracted text
+MAX_CATEGORIZATION_CHARS = 50000
+
+
+async def log_pool_status():
+    """Periodically log the database connection pool usage to surface exhaustion."""
+    while True:
+        await asyncio.sleep(DB_POOL_LOG_INTERVAL)
+        print(f"Database pool status: {engine.pool.status()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the process-wide Gemini client, which every model shares, up front instead of on the first request
+    await asyncio.to_thread(get_gemini_client)
+
+    pool_status_task = asyncio.create_task(log_pool_status()) if DB_POOL_LOG_INTERVAL > 0 else None
+
+    # Hand batches to the arq worker when a Redis queue is configured
+    app.state.arq = None
+    if REDIS_URL:
+        from arq import create_pool
+        from arq.connections import RedisSettings
+
+        app.state.arq = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+
+    yield
+
+    if app.state.arq is not None:
+        await app.state.arq.close()
+    if pool_status_task is not None:
+        pool_status_task.cancel()
+    shutdown_extraction_pool()
+
+
 app = FastAPI(
     title="Gemini 2.0 Flash Document Processor",
     description="API for processing and analyzing documents using Gemini 2.0 Flash",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized request bodies with 413 before they are downloaded.
+
+    Requests announcing a larger Content-Length are refused without reading the
+    body. For chunked requests without a Content-Length, the bytes received are
+    counted and the request is aborted as soon as the limit is crossed.
+    """
+
+    def __init__(self, app, default_limit: int, path_limits: dict):
+        self.app = app
+        self.default_limit = default_limit
+        self.path_limits = path_limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.path_limits.get(scope["path"], self.default_limit)
+        detail = f"Request body too large. Maximum size is {limit} bytes"
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                response = ORJSONResponse(
+                    {"detail": "Invalid Content-Length header"},
+                    status_code=status.HTTP_400_BAD_REQUEST
+                )
+                await response(scope, receive, send)
+                return
+            if content_length > limit:
+                response = ORJSONResponse({"detail": detail}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+                await response(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised while FastAPI parses the body, so it becomes a normal 413 response
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    default_limit=MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    path_limits={"/batch-upload": MAX_BATCH_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES}
 )
 
 # Add CORS middleware
@@ -58,16 +200,205 @@ def read_root():
 
 
 @app.get("/supported-formats", response_model=schema.SupportedFormatsResponse, tags=["General"])
-def get_supported_formats():
+def get_supported_formats(response: Response):
     """
     Get a list of supported file formats for document processing.
     """
+    # The list only changes with a deploy
+    response.headers["Cache-Control"] = "public, max-age=60"
     return {
         "supported_formats": get_supported_file_extensions(),
         "description": "List of file formats supported by the Gemini 2.0 Flash Document Processor"
     }
 
 
+def persist_documents(
+        db: Session,
+        documents: List[dict],
+        batch_id: Optional[str] = None
+) -> List[schema.DocumentWithCategory]:
+    """
+    Save processed documents and their categorization results to the database.
+
+    Each entry is a result of analyze_file. All rows are inserted with one
+    multi-row INSERT per table in a single transaction, and the generated columns
+    are read back with RETURNING, so no refresh queries are needed to build the
+    responses. Blocking; call through asyncio.to_thread from async handlers.
+    """
+    document_values = [
+        {
+            "filename": document["filename"],
+            "file_type": document["file_type"],
+            "file_size": document["file_size"],
+            "extracted_data": document["structured_data"],
+            "raw_extraction": document["extracted_text"],
+            "summary": document["summary"],
+            "batch_id": batch_id,
+            "content_sha256": document["content_sha256"]
+        }
+        for document in documents
+    ]
+    document_rows = db.execute(
+        insert(model.Document).returning(
+            model.Document.id,
+            model.Document.created_at,
+            model.Document.updated_at,
+            sort_by_parameter_order=True
+        ),
+        document_values
+    ).all()
+
+    category_values = [
+        {
+            "document_id": document_row.id,
+            "primary_category": document["categorization"].get("primary_category", "UNKNOWN"),
+            "financial_type": document["categorization"].get("financial_type", "NEUTRAL"),
+            "confidence": float(document["categorization"].get("confidence", 0)),
+            "reasoning": document["categorization"].get("reasoning", "")
+        }
+        for document, document_row in zip(documents, document_rows)
+    ]
+    category_rows = db.execute(
+        insert(model.DocumentCategory).returning(
+            model.DocumentCategory.id,
+            model.DocumentCategory.created_at,
+            sort_by_parameter_order=True
+        ),
+        category_values
+    ).all()
+
+    db.commit()
+
+    return [
+        schema.DocumentWithCategory(
+            id=document_row.id,
+            created_at=document_row.created_at,
+            updated_at=document_row.updated_at,
+            categories=[
+                schema.DocumentCategoryResponse(
+                    id=category_row.id,
+                    created_at=category_row.created_at,
+                    **category
+                )
+            ],
+            **document
+        )
+        for document, document_row, category, category_row in zip(
+            document_values, document_rows, category_values, category_rows
+        )
+    ]
+
+
+def validate_upload(file: UploadFile) -> str:
+    """Return the lowercased extension of an upload, rejecting unsupported file types with a 400."""
+    file_extension = os.path.splitext(file.filename)[1].lower()
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=INVALID_FILE_TYPE_DETAIL
+        )
+    return file_extension
+
+
+async def spool_upload(file: UploadFile) -> Tuple[tempfile.SpooledTemporaryFile, int, str]:
+    """
+    Copy an upload into a spooled temporary file chunk by chunk.
+
+    Small files stay in memory, larger ones spill to disk, so memory per upload is
+    bounded. Files over MAX_UPLOAD_BYTES are rejected with 413. Returns the rewound
+    file, its size in bytes and its SHA-256 hex digest, hashed on the way.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+    digest = hashlib.sha256()
+    file_size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        file_size += len(chunk)
+        if file_size > MAX_UPLOAD_BYTES:
+            spooled.close()
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=UPLOAD_TOO_LARGE_DETAIL
+            )
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, file_size, digest.hexdigest()
+
+
+async def analyze_file(
+        db: Session,
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        file_type: str,
+        file_size: int,
+        content_sha256: Optional[str] = None
+) -> dict:
+    """
+    Extract and analyze a single file without saving it.
+
+    Returns the input metadata together with the extracted text, structured data,
+    categorization, summary and content hash, ready for persist_documents. The
+    hash is computed here unless the caller already did so while copying the file.
+    Blocking extraction, Gemini and database work runs in worker threads so the
+    event loop stays free for other requests.
+    """
+    # A file that was processed before is served from the document cache without any extraction or Gemini calls
+    if content_sha256 is None:
+        content_sha256 = await asyncio.to_thread(hash_file, file_content)
+    cached = await asyncio.to_thread(lookup_document_cache, db, content_sha256, file_type)
+
+    if cached is not None:
+        extracted_text = cached["extracted_text"]
+        analysis = cached
+        summary = cached["summary"]
+    else:
+        # Extract text from file without blocking the event loop
+        extracted_text = await extract_text_from_file_async(file_content, filename)
+
+        # Reuse the analysis of an identical text. A near-duplicate would only lend its
+        # categorization, which saves nothing over the fused call, so none is looked up
+        analysis, _ = await asyncio.to_thread(semantic_cache.lookup, db, extracted_text, False)
+
+        if analysis is None or "structured_data" not in analysis:
+            # Extraction, categorization and summarization in a single Gemini round-trip
+            analysis = await analyze_document_batcher.submit(extracted_text)
+            summary = analysis["summary"]
+            await asyncio.to_thread(semantic_cache.store, db, extracted_text, None, analysis)
+
+            # Only a fresh analysis of this very file is cached under its hash
+            await asyncio.to_thread(store_document_cache, db, content_sha256, file_type, extracted_text, analysis, summary)
+        else:
+            # The summary is specific to this document, so it is never taken from the cache
+            summary = await asyncio.to_thread(summarize_document, extracted_text)
+
+    return {
+        "filename": filename,
+        "file_type": file_type,
+        "file_size": file_size,
+        "extracted_text": extracted_text,
+        "structured_data": analysis["structured_data"],
+        "categorization": analysis["categorization"],
+        "summary": summary,
+        "content_sha256": content_sha256
+    }
+
+
+async def process_document(
+        db: Session,
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        file_type: str,
+        file_size: int,
+        content_sha256: Optional[str] = None
+) -> schema.DocumentWithCategory:
+    """Run the full processing pipeline for a single document and save the result."""
+    document = await analyze_file(db, file_content, filename, file_type, file_size, content_sha256)
+
+    # Save document and categorization result to database
+    documents = await asyncio.to_thread(persist_documents, db, [document])
+    return documents[0]
+
+
 @app.post("/upload-document", response_model=schema.DocumentWithCategory, tags=["Documents"])
 async def upload_document(
         file: UploadFile = File(...),
@@ -84,58 +415,21 @@ async def upload_document(
     Returns the processed document with extracted data, categorization, and summary.
     """
     # Validate file type
-    if not validate_file_extension(file.filename):
-        supported_formats = ", ".join(get_supported_file_extensions())
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid file type. Supported types: {supported_formats}"
-        )
+    file_extension = validate_upload(file)
 
     try:
-        # Read file content
-        file_content = await file.read()
-        file_size = len(file_content)
-        file_extension = os.path.splitext(file.filename)[1].lower()
-
-        # Extract text from file
-        extracted_text = extract_text_from_file(file_content, file.filename)
-
-        # Extract structured data using Gemini 2.0 Flash
-        structured_data = extract_structured_data(extracted_text)
-
-        # Generate document summary
-        summary = summarize_document(extracted_text)
-
-        # Save document to database
-        db_document = model.Document(
-            filename=file.filename,
-            file_type=file_extension,
-            file_size=file_size,
-            extracted_data=structured_data,
-            summary=summary
-        )
-        db.add(db_document)
-        db.commit()
-        db.refresh(db_document)
-
-        # Categorize the document
-        categorization_result = categorize_document(extracted_text)
-
-        # Save categorization result to database
-        db_category = model.DocumentCategory(
-            document_id=db_document.id,
-            primary_category=categorization_result.get("primary_category", "UNKNOWN"),
-            financial_type=categorization_result.get("financial_type", "NEUTRAL"),
-            confidence=float(categorization_result.get("confidence", 0)),
-            reasoning=categorization_result.get("reasoning", "")
-        )
-        db.add(db_category)
-        db.commit()
-        db.refresh(db_category)
+        # Copy file content into a spooled temporary file
+        spooled, file_size, content_sha256 = await spool_upload(file)
+
+        # Extract, analyze and save the document
+        with spooled:
+            document = await process_document(db, spooled, file.filename, file_extension, file_size, content_sha256)
 
         # Return the document with its category
-        return db_document
+        return document
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -143,8 +437,134 @@ async def upload_document(
         )
 
 
+@app.post(
+    "/upload-document-async",
+    response_model=schema.JobResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["Jobs"]
+)
+async def upload_document_async(
+        response: Response,
+        background_tasks: BackgroundTasks,
+        file: UploadFile = File(...),
+        db: Session = Depends(get_db)
+):
+    """
+    Upload a single document for processing in the background.
+
+    Returns immediately with a job ID; poll `/jobs/{job_id}` for the result.
+
+    - **file**: The document file to upload (supported formats: PDF, TXT, PNG, JPG, JPEG, CSV, DOCX)
+    """
+    # Validate file type
+    file_extension = validate_upload(file)
+
+    # Copy file content now, the upload is closed once the request ends
+    spooled, file_size, content_sha256 = await spool_upload(file)
+
+    job_id = f"job_{uuid.uuid4().hex}"
+
+    # Create a job record
+    job = model.Job(
+        job_id=job_id,
+        filename=file.filename,
+        status="PENDING"
+    )
+    db.add(job)
+    db.commit()
+
+    background_tasks.add_task(
+        process_document_job,
+        job_id,
+        file.filename,
+        file_extension,
+        spooled,
+        file_size,
+        content_sha256
+    )
+
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return {
+        "job_id": job_id,
+        "status": "PENDING",
+        "message": f"Document {file.filename} queued for processing."
+    }
+
+
+def update_job(db: Session, job_id: str, **fields) -> None:
+    """Update the given fields of a job record and commit."""
+    job = db.query(model.Job).filter(model.Job.job_id == job_id).first()
+    for field, value in fields.items():
+        setattr(job, field, value)
+    db.commit()
+
+
+async def process_document_job(
+        job_id: str,
+        filename: str,
+        file_extension: str,
+        file_content: BinaryIO,
+        file_size: int,
+        content_sha256: str
+):
+    """Background task to process a single document and record the outcome on its job."""
+    # The request-scoped session is closed by the time this runs, so use a dedicated one
+    db = SessionLocal()
+    try:
+        await asyncio.to_thread(update_job, db, job_id, status="PROCESSING")
+
+        try:
+            document = await process_document(
+                db,
+                file_content,
+                filename,
+                file_extension,
+                file_size,
+                content_sha256
+            )
+
+            await asyncio.to_thread(
+                update_job,
+                db,
+                job_id,
+                status="COMPLETED",
+                document_id=document.id,
+                category_id=document.categories[0].id
+            )
+        except Exception as e:
+            print(f"Error processing job {job_id}: {str(e)}")
+            db.rollback()
+            await asyncio.to_thread(update_job, db, job_id, status="FAILED", error_message=str(e))
+    finally:
+        file_content.close()
+        db.close()
+
+
+@app.get("/jobs/{job_id}", response_model=schema.JobStatusResponse, tags=["Jobs"])
+def get_job_status(
+        job_id: str,
+        db: Session = Depends(get_db)
+):
+    """
+    Get the status of a single-document processing job.
+
+    - **job_id**: The ID of the job returned by `/upload-document-async`
+
+    Returns the job status and, once completed, the IDs of the created document and category.
+    """
+    job = db.query(model.Job).filter(model.Job.job_id == job_id).first()
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job with ID {job_id} not found"
+        )
+
+    return job
+
+
 @app.post("/batch-upload", response_model=schema.BatchUploadResponse, tags=["Batch Processing"])
 async def batch_upload(
+        request: Request,
         background_tasks: BackgroundTasks,
         files: List[UploadFile] = File(...),
         db: Session = Depends(get_db)
@@ -152,17 +572,14 @@ async def batch_upload(
     """
     Upload multiple documents for batch processing.
     """
-    # Validate all files
-    invalid_files = []
-    for file in files:
-        if not validate_file_extension(file.filename):
-            invalid_files.append(file.filename)
+    # Validate all files, computing each extension once
+    file_extensions = [(file, os.path.splitext(file.filename)[1].lower()) for file in files]
+    invalid_files = [file.filename for file, file_extension in file_extensions if file_extension not in SUPPORTED_EXTENSIONS]
 
     if invalid_files:
-        supported_formats = ", ".join(get_supported_file_extensions())
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid file types: {', '.join(invalid_files)}. Supported types: {supported_formats}"
+            detail=f"Invalid file types: {', '.join(invalid_files)}. Supported types: {SUPPORTED_FORMATS_TEXT}"
         )
 
     batch_id = f"batch_{uuid.uuid4().hex}"
@@ -177,28 +594,35 @@ async def batch_upload(
     db.add(batch_process)
     db.commit()
 
-    # Process files immediately before passing to background task
+    # Copy files to disk now, the uploads are closed once the request ends
+    batch_dir = os.path.join(UPLOAD_DIR, batch_id)
+    os.makedirs(batch_dir, exist_ok=True)
+
     file_data = []
-    for file in files:
+    for index, (file, file_extension) in enumerate(file_extensions):
+        # Files are stored under their position in the batch, client filenames are never used as paths
+        path = os.path.join(batch_dir, f"{index}{file_extension}")
         try:
-            # Read file content right now
-            content = await file.read()
+            file_size, content_sha256 = await asyncio.to_thread(save_upload_to_disk, file, path)
             file_data.append({
                 "filename": file.filename,
-                "content": content,
-                "file_type": os.path.splitext(file.filename)[1].lower(),
-                "file_size": len(content)
+                "path": path,
+                "file_type": file_extension,
+                "file_size": file_size,
+                "content_sha256": content_sha256
             })
         except Exception as e:
             print(f"Error reading file {file.filename}: {str(e)}")
 
-    # Start background task with pre-read file data
-    background_tasks.add_task(
-        process_batch_files_new,
-        file_data,
-        batch_id,
-        db
-    )
+    # Queue the batch with the paths of the saved files, on the worker queue if there is one
+    if request.app.state.arq is not None:
+        await request.app.state.arq.enqueue_job("process_batch", file_data, batch_id)
+    else:
+        background_tasks.add_task(
+            process_batch_files_new,
+            file_data,
+            batch_id
+        )
 
     return {
         "batch_id": batch_id,
@@ -208,89 +632,169 @@ async def batch_upload(
     }
 
 
-# New function for processing batch files
-def process_batch_files_new(file_data, batch_id, db_session):
-    """New background task to process batch files with pre-read data."""
+def update_batch(db: Session, batch_id: str, **fields) -> None:
+    """Update the given fields of a batch record and commit; a deleted batch is left alone."""
+    db.execute(
+        update(model.BatchProcess).where(model.BatchProcess.batch_id == batch_id).values(**fields)
+    )
+    db.commit()
+
+
+def persist_batch_documents(db: Session, documents: List[dict], batch_id: str) -> int:
+    """
+    Save the analyzed documents of a batch and return how many were saved.
+
+    Everything is inserted in bulk first. If that fails, e.g. because one document's
+    text contains a NUL byte PostgreSQL rejects, the documents are saved one by one
+    so a single bad row doesn't discard the rest of the batch.
+    """
+    if not documents:
+        return 0
+
     try:
-        # Update batch status to PROCESSING
-        batch_process = db_session.query(model.BatchProcess).filter(model.BatchProcess.batch_id == batch_id).first()
-        batch_process.status = "PROCESSING"
-        db_session.commit()
+        return len(persist_documents(db, documents, batch_id))
+    except Exception as e:
+        db.rollback()
+        print(f"Bulk insert for batch {batch_id} failed, saving documents one by one: {str(e)}")
 
-        for file_info in file_data:
-            try:
-                filename = file_info["filename"]
-                file_content = file_info["content"]
-                file_size = file_info["file_size"]
-                file_extension = file_info["file_type"]
-
-                # Extract text from file
-                extracted_text = extract_text_from_file(file_content, filename)
-
-                # Extract structured data using Gemini 2.0 Flash
-                structured_data = extract_structured_data(extracted_text)
-
-                # Generate document summary
-                summary = summarize_document(extracted_text)
-
-                # Save document to database
-                db_document = model.Document(
-                    filename=filename,
-                    file_type=file_extension,
-                    file_size=file_size,
-                    extracted_data=structured_data,
-                    summary=summary,
-                    batch_id=batch_id
-                )
-                db_session.add(db_document)
-                db_session.commit()
-
-                # Get the document ID after commit
-                document_id = db_document.id
-
-                # Categorize the document
-                categorization_result = categorize_document(extracted_text)
-
-                # Save categorization result to database
-                db_category = model.DocumentCategory(
-                    document_id=document_id,
-                    primary_category=categorization_result.get("primary_category", "UNKNOWN"),
-                    financial_type=categorization_result.get("financial_type", "NEUTRAL"),
-                    confidence=float(categorization_result.get("confidence", 0)),
-                    reasoning=categorization_result.get("reasoning", "")
-                )
-                db_session.add(db_category)
-                db_session.commit()
+    saved = 0
+    for document in documents:
+        try:
+            persist_documents(db, [document], batch_id)
+            saved += 1
+        except Exception as e:
+            # Log the error but continue saving other documents
+            db.rollback()
+            print(f"Error saving file {document['filename']}: {str(e)}")
+    return saved
 
-                # Update batch progress
-                batch_process.processed_documents += 1
-                db_session.commit()
 
-                # Add a small delay to prevent API rate limiting
-                time.sleep(0.5)
+def save_upload_to_disk(file: UploadFile, path: str) -> Tuple[int, str]:
+    """
+    Copy an upload to the given path chunk by chunk, hashing it on the way.
 
+    Returns the file's size in bytes and SHA-256 hex digest. Blocking; call
+    through asyncio.to_thread.
+    """
+    digest = hashlib.sha256()
+    file_size = 0
+    with open(path, "wb") as destination:
+        while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            file_size += len(chunk)
+            destination.write(chunk)
+    return file_size, digest.hexdigest()
+
+
+async def process_batch_files_new(file_data, batch_id):
+    """Background task to process batch files saved to disk, several at a time."""
+    # The request-scoped session is closed by the time this runs, so use a dedicated one
+    db_session = SessionLocal()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    progress_lock = asyncio.Lock()
+    analyzed = 0
+    flushed = 0
+    flushed_at = time.monotonic()
+
+    async def report_progress(count: int):
+        """Count analyzed files, writing the count only every few files or seconds."""
+        nonlocal analyzed, flushed, flushed_at
+        analyzed += count
+        if analyzed - flushed < BATCH_PROGRESS_EVERY and time.monotonic() - flushed_at < BATCH_PROGRESS_INTERVAL:
+            return
+
+        # The shared session must not be used by two threads at once
+        async with progress_lock:
+            if analyzed == flushed:
+                return
+            flushed, flushed_at = analyzed, time.monotonic()
+            try:
+                await asyncio.to_thread(update_batch, db_session, batch_id, processed_documents=flushed)
+            except Exception as e:
+                # Progress is informational; the final count is written together with the status
+                db_session.rollback()
+                print(f"Could not update progress of batch {batch_id}: {str(e)}")
+
+    async def analyze_one(copies):
+        file_info = copies[0]
+        async with semaphore:
+            # Each in-flight file gets its own session; sessions are not safe to share across threads
+            file_db = SessionLocal()
+            try:
+                with open(file_info["path"], "rb") as file_content:
+                    document = await analyze_file(
+                        file_db,
+                        file_content,
+                        file_info["filename"],
+                        file_info["file_type"],
+                        file_info["file_size"],
+                        file_info["content_sha256"]
+                    )
             except Exception as e:
                 # Log the error but continue processing other files
+                file_db.rollback()
                 print(f"Error processing file {file_info.get('filename', 'unknown')}: {str(e)}")
+                return None
+            finally:
+                file_db.close()
+                os.remove(file_info["path"])
+
+            await report_progress(len(copies))
+            return document
 
-        # Update batch status to COMPLETED
-        batch_process.status = "COMPLETED"
-        db_session.commit()
+    try:
+        await asyncio.to_thread(update_batch, db_session, batch_id, status="PROCESSING")
+
+        # Identical files in a batch are analyzed once, then saved once per upload; the
+        # extension is part of the key because it decides how the bytes are extracted
+        copies_by_hash = {}
+        for file_info in file_data:
+            copies_by_hash.setdefault((file_info["content_sha256"], file_info["file_type"]), []).append(file_info)
+
+        # Gemini rate limiting is handled by retries with backoff, bounded by the semaphore.
+        # Every task finishes before the batch directory is removed, even if one of them fails
+        results = await asyncio.gather(
+            *(analyze_one(copies) for copies in copies_by_hash.values()),
+            return_exceptions=True
+        )
+        documents = []
+        for result, copies in zip(results, copies_by_hash.values()):
+            if isinstance(result, BaseException):
+                print(f"Error processing file {copies[0]['filename']}: {str(result)}")
+                continue
+            if result is not None:
+                documents.extend(
+                    {**result, "filename": file_info["filename"], "file_type": file_info["file_type"]}
+                    for file_info in copies
+                )
+
+        # Save every successfully analyzed document, with one INSERT per table when possible
+        saved = await asyncio.to_thread(persist_batch_documents, db_session, documents, batch_id)
+
+        # Final count, together with the status change
+        await asyncio.to_thread(
+            update_batch,
+            db_session,
+            batch_id,
+            status="COMPLETED",
+            processed_documents=saved
+        )
 
     except Exception as e:
-        # Update batch status to FAILED
-        batch_process = db_session.query(model.BatchProcess).filter(model.BatchProcess.batch_id == batch_id).first()
-        if batch_process:
-            batch_process.status = "FAILED"
-            batch_process.error_message = str(e)
-            db_session.commit()
+        db_session.rollback()
+        await asyncio.to_thread(update_batch, db_session, batch_id, status="FAILED", error_message=str(e))
         print(f"Batch processing failed: {str(e)}")
+    finally:
+        db_session.close()
+        # Remove whatever files are left, e.g. when the batch failed before they were processed
+        shutil.rmtree(os.path.join(UPLOAD_DIR, batch_id), ignore_errors=True)
 
 
 @app.get("/batch-status/{batch_id}", response_model=schema.BatchProcessStatusResponse, tags=["Batch Processing"])
 def get_batch_status(
         batch_id: str,
         include_documents: bool = Query(False, description="Include processed documents in the response"),
+        include_extracted: bool = Query(False, description="Include the extracted data of each document"),
         db: Session = Depends(get_db)
 ):
     """
@@ -298,58 +802,68 @@ def get_batch_status(
 
     - **batch_id**: The ID of the batch processing job
     - **include_documents**: Whether to include the processed documents in the response
+    - **include_extracted**: Whether to include each document's extracted data (only with include_documents)
 
     Returns the status of the batch processing job and optionally the processed documents.
     """
-    batch_process = db.query(model.BatchProcess).filter(model.BatchProcess.batch_id == batch_id).first()
+    # Calculate completion percentage in the query, useful for progress bar or UI
+    completion_percentage = func.coalesce(
+        model.BatchProcess.processed_documents * 100.0 / func.nullif(model.BatchProcess.total_documents, 0),
+        0
+    )
+    batch_process = db.execute(
+        select(
+            model.BatchProcess.batch_id,
+            model.BatchProcess.status,
+            model.BatchProcess.processed_documents,
+            model.BatchProcess.total_documents,
+            completion_percentage.label("completion_percentage")
+        ).where(model.BatchProcess.batch_id == batch_id)
+    ).first()
     if not batch_process:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Batch with ID {batch_id} not found"
         )
 
-    # Calculate completion percentage, useful for progress bar or UI
-    completion_percentage = 0
-    if batch_process.total_documents > 0:
-        completion_percentage = (batch_process.processed_documents / batch_process.total_documents) * 100
-
     response = schema.BatchProcessStatusResponse(
         batch_id=batch_process.batch_id,
         status=batch_process.status,
         processed=batch_process.processed_documents,
         total=batch_process.total_documents,
-        completion_percentage=completion_percentage,
+        completion_percentage=batch_process.completion_percentage,
         documents=[]
     )
 
-    # Include documents if requested
+    # Include documents if requested, selecting only the columns the response needs
     if include_documents:
-        documents = db.query(model.Document).filter(model.Document.batch_id == batch_id).all()
-        response.documents = documents
+        columns = [
+            model.Document.id,
+            model.Document.filename,
+            model.Document.file_type,
+            model.Document.file_size,
+            model.Document.summary,
+            model.Document.created_at,
+            model.Document.updated_at
+        ]
+        if include_extracted:
+            columns.append(model.Document.extracted_data)
+
+        documents = db.execute(
+            select(*columns).where(model.Document.batch_id == batch_id).order_by(model.Document.id)
+        ).all()
+        response.documents = [schema.BatchDocumentResponse(**document._asdict()) for document in documents]
 
     return response
 
 
-@app.get("/documents", response_model=List[schema.DocumentSummary], tags=["Documents"])
-def get_documents(
-        skip: int = Query(0, description="Number of documents to skip"),
-        limit: int = Query(100, description="Maximum number of documents to return"),
-        category: Optional[str] = Query(None, description="Filter by document category"),
-        financial_type: Optional[str] = Query(None, description="Filter by financial type (INCOME, EXPENSE, NEUTRAL)"),
-        db: Session = Depends(get_db)
+def document_summary_query(
+        category: Optional[str] = None,
+        financial_type: Optional[str] = None,
+        cursor: Optional[int] = None
 ):
-    """
-    Get a list of all processed documents with pagination and filtering options.
-
-    - **skip**: Number of documents to skip
-    - **limit**: Maximum number of documents to return
-    - **category**: Filter by document category
-    - **financial_type**: Filter by financial type (INCOME, EXPENSE, NEUTRAL)
-
-    Returns a list of processed documents.
-    """
-    # Base query
-    query = db.query(
+    """Build the filtered document summary select shared by the list endpoints, ordered by ID."""
+    query = select(
         model.Document.id,
         model.Document.filename,
         model.Document.file_type,
@@ -365,35 +879,93 @@ def get_documents(
 
     # Apply filters
     if category:
-        query = query.filter(model.DocumentCategory.primary_category == category)
+        query = query.where(model.DocumentCategory.primary_category == category)
 
     if financial_type:
-        query = query.filter(model.DocumentCategory.financial_type == financial_type)
+        query = query.where(model.DocumentCategory.financial_type == financial_type)
+
+    # Keyset pagination: continue after the last ID the client has seen
+    if cursor is not None:
+        query = query.where(model.Document.id > cursor)
+
+    return query.order_by(model.Document.id)
+
+
+# Validates and serializes whole result pages in pydantic-core instead of building each model in Python
+document_summaries_adapter = TypeAdapter(List[schema.DocumentSummary])
+
+
+@app.get("/documents", response_model=List[schema.DocumentSummary], tags=["Documents"])
+def get_documents(
+        skip: int = Query(0, description="Number of documents to skip"),
+        limit: int = Query(100, description="Maximum number of documents to return"),
+        cursor: Optional[int] = Query(None, description="Only return documents with an ID greater than this"),
+        category: Optional[str] = Query(None, description="Filter by document category"),
+        financial_type: Optional[str] = Query(None, description="Filter by financial type (INCOME, EXPENSE, NEUTRAL)"),
+        db: Session = Depends(get_db)
+):
+    """
+    Get a list of all processed documents with pagination and filtering options.
+
+    - **skip**: Number of documents to skip
+    - **limit**: Maximum number of documents to return
+    - **cursor**: ID of the last document from the previous page; cheaper than `skip` for deep pages
+    - **category**: Filter by document category
+    - **financial_type**: Filter by financial type (INCOME, EXPENSE, NEUTRAL)
+
+    Returns a list of processed documents ordered by ID.
+    """
+    query = document_summary_query(category, financial_type, cursor)
 
     # Execute query with pagination
-    results = query.offset(skip).limit(limit).all()
-
-    # Convert to DocumentSummary objects
-    documents = []
-    for result in results:
-        doc = schema.DocumentSummary(
-            id=result.id,
-            filename=result.filename,
-            file_type=result.file_type,
-            summary=result.summary,
-            primary_category=result.primary_category,
-            financial_type=result.financial_type,
-            confidence=result.confidence,
-            created_at=result.created_at
-        )
-        documents.append(doc)
+    results = db.execute(query.offset(skip).limit(limit)).all()
+
+    documents = document_summaries_adapter.validate_python(results, from_attributes=True)
+    return Response(content=document_summaries_adapter.dump_json(documents), media_type="application/json")
+
+
+def generate_documents_ndjson(
+        category: Optional[str],
+        financial_type: Optional[str],
+        cursor: Optional[int]
+):
+    """Yield document summaries as newline-delimited JSON, fetching rows in chunks."""
+    # The request-scoped session is closed before the response body is streamed
+    db = SessionLocal()
+    try:
+        query = document_summary_query(category, financial_type, cursor).execution_options(yield_per=500)
+        for result in db.execute(query):
+            yield orjson.dumps(result._asdict(), option=orjson.OPT_APPEND_NEWLINE)
+    finally:
+        db.close()
+
+
+@app.get("/documents/stream", tags=["Documents"])
+def stream_documents(
+        cursor: Optional[int] = Query(None, description="Only return documents with an ID greater than this"),
+        category: Optional[str] = Query(None, description="Filter by document category"),
+        financial_type: Optional[str] = Query(None, description="Filter by financial type (INCOME, EXPENSE, NEUTRAL)")
+):
+    """
+    Stream all processed documents as newline-delimited JSON.
+
+    Rows are read from the database in chunks and written as they arrive, so the
+    full result set is never held in memory.
 
-    return documents
+    - **cursor**: Only return documents with an ID greater than this
+    - **category**: Filter by document category
+    - **financial_type**: Filter by financial type (INCOME, EXPENSE, NEUTRAL)
+    """
+    return StreamingResponse(
+        generate_documents_ndjson(category, financial_type, cursor),
+        media_type="application/x-ndjson"
+    )
 
 
 @app.get("/documents/{document_id}", response_model=schema.DocumentWithCategory, tags=["Documents"])
 def get_document(
         document_id: int,
+        request: Request,
         db: Session = Depends(get_db)
 ):
     """
@@ -403,14 +975,129 @@ def get_document(
 
     Returns the document with its extracted data, categorization, and summary.
     """
-    document = db.query(model.Document).filter(model.Document.id == document_id).first()
+    # Documents don't change after ingest, so repeat reads are served from memory
+    cached = document_response_cache.get(document_id)
+    if cached is None:
+        document = db.query(model.Document).options(
+            undefer(model.Document.raw_extraction),
+            joinedload(model.Document.categories)
+        ).filter(model.Document.id == document_id).first()
+        if not document:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Document with ID {document_id} not found"
+            )
+
+        content = orjson.dumps(schema.DocumentWithCategory.model_validate(document).model_dump())
+        # Derived from the body so re-categorizing a document changes it too
+        etag = f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+        cached = (etag, content)
+        document_response_cache.set(document_id, cached)
+
+    etag, content = cached
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+def get_categorization_text(document: model.Document) -> str:
+    """Return the text a stored document should be categorized from."""
+    if document.raw_extraction:
+        return document.raw_extraction
+
+    # Documents ingested before the raw_extraction column keep the text inside extracted_data
+    extracted_data = document.extracted_data or {}
+    if extracted_data.get("raw_extraction"):
+        return extracted_data["raw_extraction"]
+
+    # Last resort: the extracted JSON itself, bounded so huge payloads don't blow up the prompt
+    text = orjson.dumps(extracted_data).decode()
+    if len(text) > MAX_CATEGORIZATION_CHARS:
+        print(
+            f"Document {document.id} has no extracted text; categorizing from the first "
+            f"{MAX_CATEGORIZATION_CHARS} of {len(text)} characters of extracted_data. "
+            f"Re-upload it for a full categorization."
+        )
+        text = text[:MAX_CATEGORIZATION_CHARS]
+    return text
+
+
+@app.post(
+    "/categorize-document/{document_id}",
+    response_model=schema.DocumentCategoryResponse,
+    tags=["Categories"]
+)
+def categorize_document_endpoint(
+        document_id: int,
+        response: Response,
+        force: bool = Query(False, description="Re-run categorization even if the document already has one"),
+        db: Session = Depends(get_db)
+):
+    """
+    Categorize an existing document.
+
+    Returns the stored categorization when the document already has one, so repeat
+    calls don't spend Gemini tokens. With `force=true` the document is categorized
+    again and the stored result is replaced rather than duplicated.
+
+    - **document_id**: The ID of the document
+    - **force**: Re-run categorization even if the document already has one
+
+    Returns the document category; 201 Created when a new one was stored.
+    """
+    document = db.query(model.Document).options(
+        undefer(model.Document.raw_extraction)
+    ).filter(model.Document.id == document_id).first()
     if not document:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Document with ID {document_id} not found"
         )
 
-    return document
+    response.headers["Location"] = f"/documents/{document_id}"
+
+    existing = db.query(model.DocumentCategory).filter(
+        model.DocumentCategory.document_id == document_id
+    ).order_by(model.DocumentCategory.created_at.desc()).first()
+    if existing and not force:
+        return existing
+
+    text = get_categorization_text(document)
+
+    # A near-duplicate document's categorization is as good as a fresh one, unless a re-run was forced
+    cached_analysis, embedding = None, None
+    if not force:
+        cached_analysis, embedding = semantic_cache.lookup(db, text)
+
+    if cached_analysis is not None:
+        categorization_result = cached_analysis["categorization"]
+    else:
+        categorization_result = categorize_document(text)
+
+    category = existing or model.DocumentCategory(document_id=document_id)
+    category.primary_category = categorization_result.get("primary_category", "UNKNOWN")
+    category.financial_type = categorization_result.get("financial_type", "NEUTRAL")
+    category.confidence = float(categorization_result.get("confidence", 0))
+    category.reasoning = categorization_result.get("reasoning", "")
+
+    if not existing:
+        db.add(category)
+        response.status_code = status.HTTP_201_CREATED
+
+    # The flush reads generated columns back with RETURNING, so no refresh is needed after the commit
+    db.flush()
+    result = schema.DocumentCategoryResponse.model_validate(category)
+    db.commit()
+
+    # Make a fresh categorization available to later lookups, reusing the embedding computed above
+    if cached_analysis is None:
+        semantic_cache.store(db, text, embedding, {"structured_data": {}, "categorization": categorization_result})
+
+    document_response_cache.delete(document_id)
+
+    return result
 
 
 @app.get("/categories", response_model=List[schema.DocumentCategoryResponse], tags=["Categories"])
@@ -427,7 +1114,9 @@ def get_categories(
 
     Returns a list of document categories.
     """
-    categories = db.query(model.DocumentCategory).offset(skip).limit(limit).all()
+    categories = db.query(model.DocumentCategory).order_by(
+        model.DocumentCategory.id
+    ).offset(skip).limit(limit).all()
     return categories
 
 
@@ -438,38 +1127,38 @@ def get_document_type_stats(db: Session = Depends(get_db)):
 
     Returns counts of documents by primary category and financial type.
     """
-    try:
-        # Count by primary category
-        category_query = db.query(
-            model.DocumentCategory.primary_category,
-            func.count(model.DocumentCategory.id).label("count")
-        ).group_by(
-            model.DocumentCategory.primary_category
-        ).all()
+    # Counts may lag behind new uploads by up to STATS_CACHE_TTL seconds
+    stats = stats_cache.get("document_types")
+    if stats is not None:
+        return stats
 
-        # Count by financial type
-        financial_query = db.query(
-            model.DocumentCategory.financial_type,
-            func.count(model.DocumentCategory.id).label("count")
-        ).group_by(
-            model.DocumentCategory.financial_type
+    try:
+        # Count by primary category and by financial type in one scan with GROUPING SETS
+        category_grouped = func.grouping(model.DocumentCategory.primary_category).label("category_grouped")
+        rows = db.execute(
+            select(
+                model.DocumentCategory.primary_category,
+                model.DocumentCategory.financial_type,
+                func.count(model.DocumentCategory.id).label("count"),
+                category_grouped
+            ).group_by(
+                func.grouping_sets(
+                    tuple_(model.DocumentCategory.primary_category),
+                    tuple_(model.DocumentCategory.financial_type)
+                )
+            )
         ).all()
 
-        # Handle empty results
-        if not category_query:
-            category_results = {}
-        else:
-            category_results = {cat.primary_category: cat.count for cat in category_query}
-
-        if not financial_query:
-            financial_results = {}
-        else:
-            financial_results = {fin.financial_type: fin.count for fin in financial_query}
+        # GROUPING(primary_category) is 0 for the per-category rows and 1 for the per-financial-type rows
+        category_results = {row.primary_category: row.count for row in rows if row.category_grouped == 0}
+        financial_results = {row.financial_type: row.count for row in rows if row.category_grouped == 1}
 
-        return {
+        stats = {
             "primary_categories": category_results,
             "financial_types": financial_results
         }
+        stats_cache.set("document_types", stats)
+        return stats
     except Exception as e:
         # Log the error
         print(f"Error in get_document_type_stats: {str(e)}")
@@ -501,6 +1190,7 @@ def delete_document(
     # Delete the document (categories will be deleted via cascade)
     db.delete(document)
     db.commit()
+    document_response_cache.delete(document_id)
 
     return None
 
@@ -517,23 +1207,25 @@ def delete_batch(
 
     Returns no content on successful deletion.
     """
-    # Check if batch exists
-    batch = db.query(model.BatchProcess).filter(model.BatchProcess.batch_id == batch_id).first()
-    if not batch:
+    # Delete the batch record and all its documents with two statements (categories are deleted via ON DELETE CASCADE)
+    deleted_batch = db.execute(
+        delete(model.BatchProcess).where(model.BatchProcess.batch_id == batch_id).returning(model.BatchProcess.id)
+    ).first()
+    if not deleted_batch:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Batch with ID {batch_id} not found"
         )
 
-    # Delete all documents in the batch
-    documents = db.query(model.Document).filter(model.Document.batch_id == batch_id).all()
-    for document in documents:
-        db.delete(document)
-
-    # Delete the batch record
-    db.delete(batch)
+    document_ids = db.execute(
+        delete(model.Document).where(model.Document.batch_id == batch_id).returning(model.Document.id)
+    ).scalars().all()
     db.commit()
 
+    for document_id in document_ids:
+        document_response_cache.delete(document_id)
+
     return None
 
 
@@ -1,11 +1,20 @@
 # model.py
 
-from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, Float, ForeignKey
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP, Float, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql import func
 from database import Base
 
+__all__ = [
+    "Document",
+    "DocumentCategory",
+    "BatchProcess",
+    "Job",
+    "LLMCache",
+    "DocumentCache",
+]
+
 
 class Document(Base):
     __tablename__ = "documents"
@@ -15,20 +24,34 @@ class Document(Base):
     file_type = Column(String, nullable=False)
     file_size = Column(Integer, nullable=True)  # Size in bytes
     extracted_data = Column(JSONB, nullable=True)
+    raw_extraction = deferred(Column(Text, nullable=True))  # Full extracted text, only loaded when requested
     summary = Column(Text, nullable=True)
     batch_id = Column(String, nullable=True, index=True)  # For batch processing
-    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    content_sha256 = Column(String(64), nullable=True, index=True)  # SHA-256 of the uploaded file bytes
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), index=True)
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
 
     # Relationship to DocumentCategory
-    categories = relationship("DocumentCategory", back_populates="document", cascade="all, delete-orphan")
+    # Categories are removed by the database's ON DELETE CASCADE, without loading them first
+    categories = relationship(
+        "DocumentCategory",
+        back_populates="document",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
 
 
 class DocumentCategory(Base):
     __tablename__ = "document_categories"
+    __table_args__ = (
+        # Serves the category/financial type filters of the document listings and the stats grouping
+        Index("ix_doccat_primary_financial", "primary_category", "financial_type"),
+    )
+    # Fetch server-generated columns during the flush instead of with a follow-up SELECT
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False, index=True)
     primary_category = Column(String, nullable=False)
     financial_type = Column(String, nullable=False)
     confidence = Column(Float, nullable=False)
@@ -50,3 +73,43 @@ class BatchProcess(Base):
     error_message = Column(Text, nullable=True)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(String, nullable=False, index=True, unique=True)
+    filename = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="PENDING")  # PENDING, PROCESSING, COMPLETED, FAILED
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="SET NULL"), nullable=True)
+    category_id = Column(Integer, ForeignKey("document_categories.id", ondelete="SET NULL"), nullable=True)
+    error_message = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class LLMCache(Base):
+    __tablename__ = "llm_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), nullable=False, index=True, unique=True)  # Extracted text hash, see cache.analysis_key
+    analysis_version = Column(String, nullable=True, index=True)  # Model and prompt version of the cached analysis
+    embedding = Column(ARRAY(Float), nullable=True)  # Normalized text embedding for similarity lookups
+    structured_data = Column(JSONB, nullable=False)
+    categorization = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+
+class DocumentCache(Base):
+    __tablename__ = "document_cache"
+
+    cache_key = Column(String(64), primary_key=True)  # File hash, type and analysis version, see cache.document_cache_key
+    extracted_text = Column(Text, nullable=False)
+    extracted_data = Column(JSONB, nullable=False)
+    summary = Column(Text, nullable=True)
+    primary_category = Column(String, nullable=False)
+    financial_type = Column(String, nullable=False)
+    confidence = Column(Float, nullable=False)
+    reasoning = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
@@ -1,10 +1,32 @@
 # schema.py
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from typing import Dict, Any, Optional, List
 from datetime import datetime
 import os
 
+__all__ = [
+    "DocumentBase",
+    "FileResponse",
+    "DocumentCreate",
+    "DocumentResponse",
+    "DocumentCategoryBase",
+    "DocumentCategoryRequest",
+    "DocumentCategoryResponse",
+    "DocumentWithCategory",
+    "BatchProcessBase",
+    "BatchProcessResponse",
+    "BatchDocumentResponse",
+    "BatchProcessStatusResponse",
+    "BatchUploadResponse",
+    "JobResponse",
+    "JobStatusResponse",
+    "DocumentSummary",
+    "ErrorResponse",
+    "SupportedFormatsResponse",
+    "DocumentTypeStats",
+]
+
 
 class DocumentBase(BaseModel):
     filename: str
@@ -29,8 +51,7 @@ class DocumentResponse(DocumentBase):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DocumentCategoryBase(BaseModel):
@@ -49,15 +70,14 @@ class DocumentCategoryResponse(DocumentCategoryBase):
     document_id: int
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DocumentWithCategory(DocumentResponse):
+    raw_extraction: Optional[str] = None
     categories: List[DocumentCategoryResponse] = []
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class BatchProcessBase(BaseModel):
@@ -73,8 +93,19 @@ class BatchProcessResponse(BatchProcessBase):
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+class BatchDocumentResponse(DocumentBase):
+    id: int
+    file_type: str
+    file_size: Optional[int] = None
+    extracted_data: Optional[Dict[str, Any]] = None  # Only included when requested
+    summary: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
 
 
 class BatchProcessStatusResponse(BaseModel):
@@ -83,10 +114,9 @@ class BatchProcessStatusResponse(BaseModel):
     processed: int
     total: int
     completion_percentage: float
-    documents: List[DocumentResponse] = []
+    documents: List[BatchDocumentResponse] = []
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class BatchUploadResponse(BaseModel):
@@ -96,6 +126,25 @@ class BatchUploadResponse(BaseModel):
     uploaded_files: List[str]
 
 
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    message: str
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    filename: str
+    status: str
+    document_id: Optional[int] = None
+    category_id: Optional[int] = None
+    error_message: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class DocumentSummary(BaseModel):
     id: int
     filename: str
@@ -106,8 +155,7 @@ class DocumentSummary(BaseModel):
     confidence: Optional[float] = None
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ErrorResponse(BaseModel):
@@ -123,5 +171,4 @@ class DocumentTypeStats(BaseModel):
     primary_categories: Dict[str, int]
     financial_types: Dict[str, int]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,10 @@
+# conftest.py
+
+import os
+import sys
+
+# The application modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# util configures the Gemini SDK on import; tests never reach the API
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
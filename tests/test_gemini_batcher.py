@@ -0,0 +1,92 @@
+# test_gemini_batcher.py
+
+import asyncio
+import threading
+import time
+
+from util import GeminiBatcher
+
+
+class StubAnalysis:
+    """Stand-ins for analyze_document/analyze_documents that record their calls."""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.single_calls = []
+        self.batch_calls = []
+        self.batch_started = threading.Event()
+
+    def single(self, text):
+        self.single_calls.append(text)
+        return {"summary": f"single:{text}"}
+
+    def batch(self, texts):
+        self.batch_calls.append(list(texts))
+        self.batch_started.set()
+        time.sleep(self.delay)
+        return [{"summary": f"batch:{text}"} for text in texts]
+
+
+def make_batcher(stub, max_size=8, window=0.05, max_chars=1000):
+    return GeminiBatcher(stub.single, stub.batch, max_size=max_size, window=window, max_chars=max_chars)
+
+
+def test_concurrent_submits_share_one_batch():
+    stub = StubAnalysis()
+    batcher = make_batcher(stub)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(text) for text in ("a", "b", "c")))
+
+    results = asyncio.run(run())
+
+    assert stub.batch_calls == [["a", "b", "c"]]
+    assert [result["summary"] for result in results] == ["batch:a", "batch:b", "batch:c"]
+
+
+def test_batches_are_split_at_max_size_and_results_fan_out():
+    stub = StubAnalysis()
+    batcher = make_batcher(stub, max_size=2)
+    texts = [f"doc{i}" for i in range(5)]
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(text) for text in texts))
+
+    results = asyncio.run(run())
+
+    assert all(len(call) <= 2 for call in stub.batch_calls)
+    assert sorted(text for call in stub.batch_calls for text in call) == texts
+    assert [result["summary"] for result in results] == [f"batch:{text}" for text in texts]
+
+
+def test_long_texts_bypass_batching():
+    stub = StubAnalysis()
+    batcher = make_batcher(stub, max_chars=3)
+
+    result = asyncio.run(batcher.submit("too long"))
+
+    assert result == {"summary": "single:too long"}
+    assert stub.single_calls == ["too long"]
+    assert stub.batch_calls == []
+
+
+def test_cancelled_submitter_does_not_block_the_rest_of_its_batch():
+    stub = StubAnalysis(delay=0.1)
+    batcher = make_batcher(stub)
+
+    async def run():
+        cancelled = asyncio.create_task(batcher.submit("a"))
+        survivor = asyncio.create_task(batcher.submit("b"))
+
+        # Cancel the first caller while its batch is being processed
+        await asyncio.to_thread(stub.batch_started.wait, 1)
+        cancelled.cancel()
+
+        result = await asyncio.wait_for(survivor, timeout=1)
+        return cancelled, result
+
+    cancelled, result = asyncio.run(run())
+
+    assert cancelled.cancelled()
+    assert result == {"summary": "batch:b"}
+    assert stub.batch_calls == [["a", "b"]]
@@ -1,32 +1,64 @@
 # util.py
 
 import os
+import re
 import json
+import orjson
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from PIL import Image
 import PyPDF2
+import pypdfium2 as pdfium
 import io
 import logging
 import base64
-from typing import List, Dict, Any, Optional, Union, Tuple
+from typing import Callable, List, Dict, Any, Optional, Union, Tuple, BinaryIO, TypedDict
 import docx2txt
+import chardet
+import diskcache
 import csv
-import tempfile
+import asyncio
+import functools
+import multiprocessing
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import random
+import time
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
 
-# Configure the Gemini API
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    raise ValueError("GEMINI_API_KEY is not set in .env file")
+def _init() -> None:
+    """
+    Configure logging, load .env and configure the Gemini SDK.
+
+    Runs once per process on import; later calls are no-ops, so any entry point
+    (API, arq worker, scripts) can call it safely.
+    """
+    if getattr(_init, "done", False):
+        return
+
+    # Configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    # Load environment variables
+    load_dotenv()
+
+    # Configure the Gemini API
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY is not set in .env file")
 
-genai.configure(api_key=api_key)
+    # The default gRPC transport multiplexes every concurrent call over one persistent
+    # HTTP/2 connection held by the shared client (see get_gemini_client). "rest" is
+    # available for environments where gRPC is blocked.
+    genai.configure(api_key=api_key, transport=os.getenv("GEMINI_TRANSPORT", "grpc"))
+    _init.done = True
+
+
+_init()
 
 # Global variables for configuration
 SUPPORTED_EXTENSIONS = {
@@ -40,118 +72,526 @@ SUPPORTED_EXTENSIONS = {
 }
 
 GEMINI_MODEL_NAME = 'gemini-2.0-flash'
+EMBEDDING_MODEL_NAME = 'models/text-embedding-004'
+
+# The embedding model accepts ~2048 tokens, so only the start of long documents is embedded
+EMBEDDING_MAX_CHARS = 8000
+
+# Micro-batching of concurrent extraction/categorization calls (see GeminiBatcher)
+GEMINI_BATCH_MAX_SIZE = int(os.getenv("GEMINI_BATCH_MAX_SIZE", "8"))
+GEMINI_BATCH_WINDOW = float(os.getenv("GEMINI_BATCH_WINDOW", "0.1"))
+GEMINI_BATCH_MAX_CHARS = int(os.getenv("GEMINI_BATCH_MAX_CHARS", "20000"))
+
+# PDF and DOCX parsing is CPU-bound, so it runs in worker processes instead of threads
+CPU_BOUND_EXTENSIONS = {".pdf", ".docx"}
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+
+# The Gemini cleanup pass over conventionally extracted text is opt-in; PDFs whose
+# extraction has less than GARBLED_TEXT_THRESHOLD printable characters always get it
+ENHANCE_EXTRACTION = os.getenv("GEMINI_ENHANCE_EXTRACTION", "false").lower() == "true"
+GARBLED_TEXT_THRESHOLD = 0.9
+
+# Images are downscaled and re-encoded before being sent to Gemini for text extraction
+IMAGE_MAX_SIDE = 1600
+IMAGE_JPEG_QUALITY = 85
+
+# Persistent cache of Gemini responses for identical inputs; bump PROMPT_VERSION whenever a prompt changes
+PROMPT_VERSION = "3"
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE", "true").lower() == "true"
+GEMINI_CACHE_DIR = os.getenv("GEMINI_CACHE_DIR", ".gemini_cache")
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+# Maximum number of concurrent Gemini-bound steps in process_batch_documents
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+
+# Texts longer than GEMINI_CHUNK_CHARS are split into overlapping chunks that are analyzed
+# in parallel and merged, keeping each request well under Gemini's request size limit
+GEMINI_CHUNK_CHARS = int(os.getenv("GEMINI_CHUNK_CHARS", "50000"))
+GEMINI_CHUNK_OVERLAP = int(os.getenv("GEMINI_CHUNK_OVERLAP", "1000"))
+
+# Retries with exponential backoff when Gemini rate limits a call (HTTP 429 / RESOURCE_EXHAUSTED)
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1.0"))
+
+# Prompt building blocks shared by the single-task and the combined analysis instructions
+STRUCTURED_DATA_FIELDS = """\
+Include fields that are relevant to the document type such as:
+- Document type (invoice, receipt, contract, etc.)
+- Names of individuals or companies
+- Dates (issue date, due date, service dates)
+- Monetary amounts (totals, subtotals, tax amounts)
+- Addresses and contact information
+- Product or service descriptions
+- Any identifiers (invoice numbers, order numbers)
+- Any other relevant structured data
+"""
+
+PRIMARY_CATEGORIES = """\
+Primary categories:
+1. "INVOICE" - Bills requesting payment for goods or services
+2. "RECEIPT" - Proof of completed payment for goods or services
+3. "CONTRACT" - Legal agreements between parties
+4. "REPORT" - Information documents presenting data or findings
+5. "CORRESPONDENCE" - Letters, emails or communication documents
+6. "FINANCIAL" - Financial statements, reports, or records
+7. "ID_DOCUMENT" - Identification documents like passports, licenses
+8. "OTHER" - For documents that don't fit the above categories
+"""
+
+FINANCIAL_TYPES = """\
+Please also classify if the document is primarily related to:
+- "INCOME" - If it's related to sales, revenue, income, or money coming in
+- "EXPENSE" - If it's related to purchases, expenses, costs, or money going out
+- "NEUTRAL" - If it doesn't clearly relate to income or expenses
+"""
+
+CATEGORIZATION_RESULT_FIELDS = """\
+    "primary_category": "CATEGORY_NAME",
+    "financial_type": "INCOME, EXPENSE or NEUTRAL",
+    "confidence": number between 0-1,
+    "reasoning": "brief explanation for this categorization"
+"""
+
+STRUCTURED_DATA_INSTRUCTIONS = (
+    "\nExtract key entities and structured values from the following document as JSON format.\n"
+    + STRUCTURED_DATA_FIELDS
+    + "\nReturn only a valid JSON object without any explanation or additional text.\n"
+)
+
+CATEGORIZATION_INSTRUCTIONS = (
+    "\nAnalyze the following document text and categorize it into the most appropriate category:\n\n"
+    + PRIMARY_CATEGORIES
+    + "\n"
+    + FINANCIAL_TYPES
+    + "\nReturn only a JSON object with the following structure:\n{\n"
+    + CATEGORIZATION_RESULT_FIELDS
+    + "}\n"
+)
+
+ANALYSIS_TASKS = (
+    "Task 1 - Extract key entities and structured values from the document.\n"
+    + STRUCTURED_DATA_FIELDS
+    + "\nTask 2 - Categorize the document into the most appropriate category:\n\n"
+    + PRIMARY_CATEGORIES
+    + "\n"
+    + FINANCIAL_TYPES
+    + "\nTask 3 - Summarize the document in no more than 3-5 sentences.\n"
+    "Focus on the key information and main purpose of the document.\n"
+)
+
+ANALYSIS_RESULT_STRUCTURE = (
+    "{\n"
+    '    "structured_data": { "field name": "extracted value", ... },\n'
+    '    "summary": "concise summary of the document",\n'
+    + CATEGORIZATION_RESULT_FIELDS
+    + "}\n"
+)
+
+ANALYZE_DOCUMENT_INSTRUCTIONS = (
+    "\nAnalyze the following document text and perform three tasks.\n\n"
+    + ANALYSIS_TASKS
+    + "\nReturn only a JSON object with the following structure:\n"
+    + ANALYSIS_RESULT_STRUCTURE
+)
+
+# Used for micro-batched analyze_documents calls, which need an array of results
+ANALYZE_DOCUMENTS_INSTRUCTIONS = (
+    "\nThe text contains several documents, each starting with a \"--- Document N ---\" line.\n"
+    "Analyze each document independently and perform three tasks for it.\n\n"
+    + ANALYSIS_TASKS
+    + "\nReturn only a JSON array containing exactly one object per document, in the same order\n"
+    "as the documents, each with the following structure:\n"
+    + ANALYSIS_RESULT_STRUCTURE
+)
+
+# Per-call prompt templates, filled in with str.format; bump PROMPT_VERSION when editing them
+DOCUMENT_PROMPT_TEMPLATE = """
+Document text:
+{text}
+"""
+
+BATCH_DOCUMENT_TEMPLATE = "--- Document {number} ---\n{text}"
+
+BATCH_ANALYSIS_PROMPT_TEMPLATE = """
+Analyze each of the following {count} documents independently.
+Return a JSON array containing exactly one result object per document, in the same order.
+
+{documents}
+"""
+
+SUMMARY_PROMPT_TEMPLATE = """
+Provide a concise summary of the following document in no more than 3-5 sentences.
+Focus on the key information and main purpose of the document.
+
+Document text:
+{text}
+"""
+
+KEY_VALUE_PROMPT_TEMPLATE = """
+Extract all key-value pairs from this document.
+Format the result as a JSON object where keys are the field names
+and values are the corresponding values found in the document.
+
+Return only a valid JSON object without any explanation or additional text.
+
+Document text:
+{text}
+"""
+
+ENHANCE_TEXT_PROMPT_TEMPLATE = """
+Process and enhance this extracted document text, preserving its structure and formatting as much as possible.
+If the text appears to be structured data, preserve that structure.
+
+Extracted text:
+{text}
+"""
+
+IMAGE_TEXT_PROMPT = "Extract all visible text from this image, preserving structure and formatting:"
+
+
+class CategorizationResult(TypedDict):
+    """Response schema for categorize_document."""
+    primary_category: str
+    financial_type: str
+    confidence: float
+    reasoning: str
+
+
+# Matches a JSON response wrapped in a ```json ... ``` (or bare ```) code fence
+_JSON_FENCE_RE = re.compile(r"\s*```(?:json)?\s*(.*?)\s*```\s*", re.DOTALL)
+
+# Free-form JSON output; structured data and key-value pairs have no fixed set of keys
+JSON_GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json")
+
+CATEGORIZATION_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=CategorizationResult
+)
+
+SYSTEM_INSTRUCTIONS = {
+    "structured_data": STRUCTURED_DATA_INSTRUCTIONS,
+    "categorization": CATEGORIZATION_INSTRUCTIONS,
+    "analyze_document": ANALYZE_DOCUMENT_INSTRUCTIONS,
+    "analyze_documents": ANALYZE_DOCUMENTS_INSTRUCTIONS,
+}
+
+# GenerativeModel instances built by get_gemini_model, keyed by instruction
+_models: Dict[Optional[str], genai.GenerativeModel] = {}
+
+# On-disk Gemini response cache, opened on first use
+_response_cache: Optional[diskcache.Cache] = None
+
+# Process pool for CPU_BOUND_EXTENSIONS, created on first use
+_extraction_pool: Optional[ProcessPoolExecutor] = None
 
 
-def get_supported_file_extensions() -> List[str]:
-    """Return a list of supported file extensions."""
-    return list(SUPPORTED_EXTENSIONS.keys())
+@functools.lru_cache(maxsize=1)
+def get_supported_file_extensions() -> Tuple[str, ...]:
+    """Return the supported file extensions, built once and shared by all callers."""
+    return tuple(SUPPORTED_EXTENSIONS)
 
 
 def validate_file_extension(filename: str) -> bool:
-    """Validate if the file extension is supported."""
-    file_extension = os.path.splitext(filename)[1].lower()
-    return file_extension in SUPPORTED_EXTENSIONS
+    """Validate if the file extension is supported (a dict lookup, no list scan)."""
+    return os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def get_gemini_client():
+    """
+    Return the process-wide Gemini generative service client.
+
+    The SDK keeps one client per process and every GenerativeModel picks it up
+    lazily, so all requests share its connection. Calling this at startup opens
+    the connection before the first request needs it.
+    """
+    return genai_client.get_default_generative_client()
 
 
-def get_gemini_model():
-    """Get the Gemini model with proper error handling."""
+def get_gemini_model(instruction_key: Optional[str] = None):
+    """
+    Get the Gemini model with proper error handling.
+
+    When instruction_key names one of SYSTEM_INSTRUCTIONS, the model is bound to
+    that instruction. Models are built once and shared; they are stateless and
+    use the process-wide client.
+    """
+    model = _models.get(instruction_key)
+    if model is not None:
+        return model
+
     try:
-        return genai.GenerativeModel(GEMINI_MODEL_NAME)
+        if instruction_key:
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=SYSTEM_INSTRUCTIONS[instruction_key])
+        else:
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME)
     except Exception as e:
         logger.error(f"Failed to initialize Gemini model: {e}")
         raise RuntimeError(f"Failed to initialize Gemini model: {e}")
 
+    _models[instruction_key] = model
+    return model
 
-def extract_text_from_txt(file_content: bytes) -> str:
-    """Extract text from a text file."""
+
+def generate_with_retry(model, contents, **kwargs):
+    """
+    Call model.generate_content, backing off exponentially (with jitter) while
+    Gemini reports rate limiting. Blocking; meant to run in a worker thread.
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            return model.generate_content(contents, **kwargs)
+        except google_exceptions.ResourceExhausted as e:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = GEMINI_RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Gemini rate limit hit, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+
+def request_text(model, contents, stream: bool = False, **kwargs) -> str:
+    """
+    Return the text of a Gemini response. With stream=True the response is
+    received in chunks as it is generated, so long outputs don't sit on one
+    idle request until the model has finished.
+    """
+    if not stream:
+        return generate_with_retry(model, contents, **kwargs).text
+
+    response = generate_with_retry(model, contents, stream=True, **kwargs)
+    return "".join(chunk.text for chunk in response if chunk.parts)
+
+
+def get_response_cache() -> Optional[diskcache.Cache]:
+    """Return the on-disk Gemini response cache, or None when it is disabled."""
+    global _response_cache
+    if GEMINI_CACHE_ENABLED and _response_cache is None:
+        _response_cache = diskcache.Cache(GEMINI_CACHE_DIR)
+    return _response_cache
+
+
+def is_usable_text(response_text: str) -> bool:
+    """Return whether a free-text Gemini response is worth caching."""
+    return bool(response_text.strip())
+
+
+def is_json_object(response_text: str) -> bool:
+    """Return whether a Gemini response parses to a JSON object."""
+    try:
+        return isinstance(parse_gemini_json(response_text), dict)
+    except json.JSONDecodeError:
+        return False
+
+
+def is_complete_analysis(response_text: str) -> bool:
+    """Return whether a combined analysis response has the structured data and summary split_analysis needs."""
     try:
-        return file_content.decode("utf-8")
+        result = parse_gemini_json(response_text)
+    except json.JSONDecodeError:
+        return False
+    return (
+        isinstance(result, dict)
+        and isinstance(result.get("structured_data"), dict)
+        and isinstance(result.get("summary"), str)
+        and bool(result["summary"].strip())
+    )
+
+
+def generate_text(
+        model,
+        contents,
+        cache_parts: Tuple[Union[str, bytes], ...],
+        stream: bool = False,
+        validate: Callable[[str], bool] = is_usable_text,
+        **kwargs
+) -> str:
+    """
+    Return the text of a Gemini response, reusing a cached one for identical inputs.
+
+    cache_parts must identify the request completely (task name, prompt, file bytes);
+    the model name and PROMPT_VERSION are added to the key. Responses are kept for
+    GEMINI_CACHE_TTL seconds, but only if validate accepts them, so a truncated or
+    malformed response isn't replayed. stream is passed on to request_text.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return request_text(model, contents, stream, **kwargs)
+
+    digest = hashlib.sha256()
+    for part in (GEMINI_MODEL_NAME, PROMPT_VERSION, *cache_parts):
+        data = part.encode("utf-8") if isinstance(part, str) else part
+        # Length-prefix each part so different splits of the same bytes don't collide
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    key = digest.hexdigest()
+
+    text = cache.get(key)
+    if text is None:
+        text = request_text(model, contents, stream, **kwargs)
+        if validate(text):
+            cache.set(key, text, expire=GEMINI_CACHE_TTL)
+    return text
+
+
+def embed_text(text: str) -> List[float]:
+    """Embed document text with the Gemini embedding model for similarity lookups."""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL_NAME,
+        content=text[:EMBEDDING_MAX_CHARS],
+        task_type="semantic_similarity"
+    )
+    return result["embedding"]
+
+
+def as_stream(file_content: Union[bytes, BinaryIO]) -> BinaryIO:
+    """Return a binary stream for file content given as bytes or as a file-like object."""
+    if isinstance(file_content, (bytes, bytearray)):
+        return io.BytesIO(file_content)
+    return file_content
+
+
+def as_bytes(file_content: Union[bytes, BinaryIO]) -> bytes:
+    """Return file content given as bytes or as a file-like object as bytes."""
+    if isinstance(file_content, (bytes, bytearray)):
+        return bytes(file_content)
+    return file_content.read()
+
+
+def decode_text(data: bytes) -> str:
+    """Decode text file bytes as UTF-8, falling back to the encoding chardet detects."""
+    try:
+        return data.decode("utf-8")
     except UnicodeDecodeError:
-        # Try with different encodings if UTF-8 fails
+        encoding = chardet.detect(data)["encoding"] or "latin-1"
+        logger.info(f"Text is not valid UTF-8, decoding as {encoding}")
         try:
-            return file_content.decode("latin-1")
-        except Exception as e:
-            logger.error(f"Error decoding text file: {e}")
-            raise
+            return data.decode(encoding, errors="replace")
+        except LookupError:
+            return data.decode("latin-1")
+
+
+def extract_text_from_txt(file_content: Union[bytes, BinaryIO]) -> str:
+    """Extract text from a text file."""
+    return decode_text(as_bytes(file_content))
+
+
+def extract_text_from_pdf(file_content: Union[bytes, BinaryIO]) -> str:
+    """
+    Extract text from a PDF file with PDFium, which is much faster than PyPDF2 and
+    handles ligatures better. Falls back to PyPDF2 for files PDFium can't read.
+    """
+    file_content = as_bytes(file_content)
+    try:
+        return extract_text_from_pdf_pdfium(file_content)
+    except Exception as e:
+        logger.warning(f"PDFium could not extract text from PDF, falling back to PyPDF2: {e}")
+        return extract_text_from_pdf_pypdf2(file_content)
 
 
-def extract_text_from_pdf(file_content: bytes) -> str:
-    """Extract text from a PDF file."""
+def extract_text_from_pdf_pdfium(file_content: bytes) -> str:
+    """Extract text from a PDF file with pypdfium2."""
+    pdf = pdfium.PdfDocument(file_content)
+    try:
+        parts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            parts.append(textpage.get_text_range() + "\n")
+            textpage.close()
+            page.close()
+        return "".join(parts)
+    finally:
+        pdf.close()
+
+
+def extract_text_from_pdf_pypdf2(file_content: Union[bytes, BinaryIO]) -> str:
+    """Extract text from a PDF file with PyPDF2."""
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        pdf_reader = PyPDF2.PdfReader(as_stream(file_content))
+        # Pages share the reader's stream and are parsed under the GIL, so they are read in
+        # order; whole files are parallelized across processes by extract_text_from_file_async
+        return "".join((page.extract_text() or "") + "\n" for page in pdf_reader.pages)
     except Exception as e:
         logger.error(f"Error extracting text from PDF: {e}")
         raise
 
 
-def extract_text_from_docx(file_content: bytes) -> str:
+def extract_text_from_docx(file_content: Union[bytes, BinaryIO]) -> str:
     """Extract text from a DOCX file."""
     try:
-        # Create a temporary file to write the bytes
-        with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as temp_file:
-            temp_file.write(file_content)
-            temp_filename = temp_file.name
-
-        # Extract text from the temporary file
-        text = docx2txt.process(temp_filename)
-
-        # Clean up the temporary file
-        os.unlink(temp_filename)
-
-        return text
+        # docx2txt opens the document with zipfile, which reads seekable file objects directly
+        return docx2txt.process(as_stream(file_content))
     except Exception as e:
         logger.error(f"Error extracting text from DOCX: {e}")
         raise
 
 
-def extract_text_from_csv(file_content: bytes) -> str:
+def extract_text_from_csv(file_content: Union[bytes, BinaryIO]) -> str:
     """Extract text from a CSV file and format it as a string."""
     try:
         # Decode the CSV file content
-        csv_text = file_content.decode('utf-8')
+        csv_text = decode_text(as_bytes(file_content))
 
         # Parse CSV using csv module
         csv_reader = csv.reader(csv_text.splitlines())
 
         # Convert CSV to formatted text
-        formatted_text = ""
-        for row in csv_reader:
-            formatted_text += " | ".join(row) + "\n"
-
-        return formatted_text
+        return "".join(" | ".join(row) + "\n" for row in csv_reader)
     except Exception as e:
         logger.error(f"Error extracting text from CSV: {e}")
         raise
 
 
-def extract_text_with_gemini(file_content: bytes, file_extension: str, original_extraction: str = "") -> str:
+def prepare_image(image_bytes: bytes) -> Dict[str, Any]:
+    """
+    Downscale an image to at most IMAGE_MAX_SIDE pixels on its long side and
+    re-encode it as JPEG, returning it as a Gemini inline data part.
+
+    Phone photos are far larger than needed to read text from them, and Gemini
+    bills image tokens and upload time by size. Images that are small enough
+    already are passed through in their original format.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    if max(image.size) <= IMAGE_MAX_SIDE and image.format in ("PNG", "JPEG"):
+        return {"mime_type": Image.MIME[image.format], "data": image_bytes}
+
+    # JPEG has no alpha channel; flatten transparency onto white so dark text stays visible
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+
+def extract_text_with_gemini(
+        file_content: Union[bytes, BinaryIO],
+        file_extension: str,
+        original_extraction: str = ""
+) -> str:
     """Use Gemini 2.0 Flash to enhance text extraction."""
     try:
         model = get_gemini_model()
 
         # For images, use Gemini's multimodal capabilities
         if file_extension in ['.png', '.jpg', '.jpeg']:
-            image = Image.open(io.BytesIO(file_content))
-            response = model.generate_content(
-                ["Extract all visible text from this image, preserving structure and formatting:", image]
+            image_bytes = as_bytes(file_content)
+            return generate_text(
+                model,
+                [IMAGE_TEXT_PROMPT, prepare_image(image_bytes)],
+                ("image_text", image_bytes),
+                stream=True
             )
-            return response.text
 
         # For text-based documents, use Gemini to improve the extraction
-        prompt = f"""
-        Process and enhance this extracted document text, preserving its structure and formatting as much as possible.
-        If the text appears to be structured data, preserve that structure.
-
-        Extracted text:
-        {original_extraction}
-        """
+        prompt = ENHANCE_TEXT_PROMPT_TEMPLATE.format(text=original_extraction)
 
-        response = model.generate_content(prompt)
-        return response.text
+        # The enhanced text is as long as the document, so stream it in
+        return generate_text(model, prompt, ("enhance_text", prompt), stream=True)
     except Exception as e:
         logger.error(f"Error using Gemini for text extraction: {e}")
         # Fall back to the original extraction if Gemini fails
@@ -160,76 +600,239 @@ def extract_text_with_gemini(file_content: bytes, file_extension: str, original_
         raise
 
 
-def extract_text_from_file(file_content: bytes, filename: str) -> str:
-    """Extract text from various file types with Gemini 2.0 Flash enhancement when possible."""
+def extract_conventional_text(file_content: Union[bytes, BinaryIO], file_extension: str) -> str:
+    """Extract text from a non-image file with the format's parser alone, without Gemini."""
+    if file_extension == '.txt':
+        return extract_text_from_txt(file_content)
+    elif file_extension == '.pdf':
+        return extract_text_from_pdf(file_content)
+    elif file_extension == '.docx':
+        return extract_text_from_docx(file_content)
+    elif file_extension == '.csv':
+        return extract_text_from_csv(file_content)
+    else:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+
+
+def needs_enhancement(text: str, file_extension: str, enhance: bool) -> bool:
+    """
+    Decide whether conventionally extracted text is worth a Gemini cleanup pass.
+
+    TXT and CSV are already clean text and are never enhanced. Other formats are
+    enhanced when requested, and PDFs also when the extraction looks garbled.
+    """
+    if file_extension in ('.txt', '.csv'):
+        return False
+    if enhance:
+        return True
+    if file_extension == '.pdf' and text:
+        printable = sum(c.isprintable() or c.isspace() for c in text)
+        return printable / len(text) < GARBLED_TEXT_THRESHOLD
+    return False
+
+
+def extract_text_from_file(
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        enhance: bool = ENHANCE_EXTRACTION
+) -> str:
+    """
+    Extract text from various file types, using Gemini 2.0 Flash for images and,
+    when needs_enhancement says so, to clean up conventionally extracted text.
+    The content can be given as bytes or as a readable binary file object.
+    """
     file_extension = os.path.splitext(filename)[1].lower()
 
-    # Conventional extraction first
     try:
-        if file_extension == '.txt':
-            original_text = extract_text_from_txt(file_content)
-        elif file_extension == '.pdf':
-            original_text = extract_text_from_pdf(file_content)
-        elif file_extension in ['.png', '.jpg', '.jpeg']:
-            # For images, we'll rely completely on Gemini
+        # For images, we'll rely completely on Gemini
+        if file_extension in ['.png', '.jpg', '.jpeg']:
             return extract_text_with_gemini(file_content, file_extension)
-        elif file_extension == '.docx':
-            original_text = extract_text_from_docx(file_content)
-        elif file_extension == '.csv':
-            original_text = extract_text_from_csv(file_content)
-        else:
-            raise ValueError(f"Unsupported file type: {file_extension}")
 
-        # Use Gemini to enhance the extraction (except for images which are handled directly)
-        if file_extension not in ['.png', '.jpg', '.jpeg']:
+        # Conventional extraction first, then use Gemini to enhance it only where it pays off
+        original_text = extract_conventional_text(file_content, file_extension)
+        if needs_enhancement(original_text, file_extension, enhance):
             return extract_text_with_gemini(file_content, file_extension, original_text)
+        return original_text
+    except Exception as e:
+        logger.error(f"Error extracting text from file {filename}: {e}")
+        raise
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """Return the shared process pool for CPU-bound extraction, creating it on first use."""
+    global _extraction_pool
+    if _extraction_pool is None:
+        # By now the process runs the gRPC client and worker threads, which fork() would copy in an
+        # inconsistent state, so workers are started from a clean forkserver (spawn on Windows)
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _extraction_pool = ProcessPoolExecutor(
+            max_workers=EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context(start_method)
+        )
+    return _extraction_pool
+
+
+def shutdown_extraction_pool() -> None:
+    """Stop the extraction worker processes, if any were started."""
+    global _extraction_pool
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown(cancel_futures=True)
+        _extraction_pool = None
+
+
+async def run_in_extraction_pool(extract_fn, file_content: Union[bytes, BinaryIO], *args) -> str:
+    """Run a conventional extractor in the extraction process pool."""
+    # File objects can't be sent to another process, their bytes can
+    content = await asyncio.to_thread(as_bytes, file_content)
+    return await asyncio.get_running_loop().run_in_executor(get_extraction_pool(), extract_fn, content, *args)
+
+
+async def extract_text_from_pdf_async(file_content: Union[bytes, BinaryIO]) -> str:
+    """Async version of extract_text_from_pdf, parsing in the extraction process pool."""
+    return await run_in_extraction_pool(extract_text_from_pdf, file_content)
+
+
+async def extract_text_from_docx_async(file_content: Union[bytes, BinaryIO]) -> str:
+    """Async version of extract_text_from_docx, parsing in the extraction process pool."""
+    return await run_in_extraction_pool(extract_text_from_docx, file_content)
+
+
+async def extract_text_from_file_async(
+        file_content: Union[bytes, BinaryIO],
+        filename: str,
+        enhance: bool = ENHANCE_EXTRACTION
+) -> str:
+    """
+    Async version of extract_text_from_file that keeps the event loop responsive.
+
+    PDF and DOCX parsing runs in the extraction process pool, so it doesn't hold
+    the GIL of the server process. Everything else, including the I/O-bound Gemini
+    calls, runs in a worker thread.
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension not in CPU_BOUND_EXTENSIONS:
+        return await asyncio.to_thread(extract_text_from_file, file_content, filename, enhance)
+
+    try:
+        content = await asyncio.to_thread(as_bytes, file_content)
+        if file_extension == '.pdf':
+            original_text = await extract_text_from_pdf_async(content)
+        else:
+            original_text = await extract_text_from_docx_async(content)
 
+        if needs_enhancement(original_text, file_extension, enhance):
+            return await asyncio.to_thread(extract_text_with_gemini, content, file_extension, original_text)
         return original_text
     except Exception as e:
         logger.error(f"Error extracting text from file {filename}: {e}")
         raise
 
 
+def parse_gemini_json(response_text: str) -> Any:
+    """
+    Parse the JSON in a Gemini response.
+
+    JSON mode responses are plain JSON; a surrounding ``` code fence, which older
+    cached responses may have, is tolerated. Raises json.JSONDecodeError (which
+    orjson's error subclasses) on invalid JSON.
+    """
+    match = _JSON_FENCE_RE.fullmatch(response_text)
+    return orjson.loads(match.group(1) if match else response_text)
+
+
+def _chunk_text(text: str, size: int = GEMINI_CHUNK_CHARS, overlap: int = GEMINI_CHUNK_OVERLAP) -> List[str]:
+    """Split text into chunks of at most size characters, each overlapping the previous one."""
+    if len(text) <= size:
+        return [text]
+
+    # Prefer to cut at a line break in the second half of the chunk
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            newline = text.rfind("\n", start + size // 2, end)
+            if newline != -1:
+                end = newline + 1
+        chunks.append(text[start:end])
+        if end == len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def _map_concurrently(fn, texts: List[str]) -> List[Any]:
+    """Run a Gemini-bound fn over several texts in parallel threads, keeping their order."""
+    with ThreadPoolExecutor(max_workers=max(1, min(len(texts), GEMINI_CONCURRENCY))) as executor:
+        return list(executor.map(fn, texts))
+
+
+def _merge_structured_data(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the structured data extracted from the chunks of one document.
+
+    The first chunk to report a field wins; list values are concatenated
+    without duplicates, which the chunk overlap otherwise produces.
+    """
+    merged: Dict[str, Any] = {}
+    for result in results:
+        for key, value in result.items():
+            existing = merged.setdefault(key, value)
+            if existing is value:
+                continue
+            if isinstance(existing, list) and isinstance(value, list):
+                merged[key] = existing + [item for item in value if item not in existing]
+    return merged
+
+
+def _merge_categorizations(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Pick the most confident categorization among the chunks of one document."""
+    valid = [r for r in results if r.get("primary_category") not in ("ERROR", "UNKNOWN", None)]
+    if not valid:
+        return results[0]
+    return max(valid, key=lambda r: float(r.get("confidence") or 0))
+
+
+def _reduce_summaries(summaries: List[str]) -> str:
+    """Combine the summaries of the chunks of one document into a single summary."""
+    summaries = [summary for summary in summaries if summary != "Error generating summary."]
+    if not summaries:
+        return "Error generating summary."
+    if len(summaries) == 1:
+        return summaries[0]
+    return summarize_document("\n\n".join(summaries))
+
+
 def extract_structured_data(text: str) -> Dict[str, Any]:
     """Extract structured data from text using Gemini 2.0 Flash."""
+    chunks = _chunk_text(text)
+    if len(chunks) > 1:
+        results = _map_concurrently(extract_structured_data, chunks)
+        for result in results:
+            result.pop("raw_extraction", None)
+        structured_data = _merge_structured_data(results)
+        structured_data["raw_extraction"] = text
+        return structured_data
+
     try:
-        model = get_gemini_model()
+        model = get_gemini_model("structured_data")
 
-        # Create a prompt for structured data extraction
-        prompt = f"""
-        Extract key entities and structured values from the following document as JSON format.
-        Include fields that are relevant to the document type such as:
-        - Document type (invoice, receipt, contract, etc.)
-        - Names of individuals or companies
-        - Dates (issue date, due date, service dates)
-        - Monetary amounts (totals, subtotals, tax amounts)
-        - Addresses and contact information
-        - Product or service descriptions
-        - Any identifiers (invoice numbers, order numbers)
-        - Any other relevant structured data
-
-        Return only a valid JSON object without any explanation or additional text.
-
-        Document text:
-        {text}
-        """
+        # Only the document text varies per call, the instructions are the model's system instruction
+        prompt = DOCUMENT_PROMPT_TEMPLATE.format(text=text)
 
-        # Generate response
-        response = model.generate_content(prompt)
-        response_text = response.text
+        # Generate response in JSON mode so no code-fence stripping is needed
+        response_text = generate_text(
+            model,
+            prompt,
+            ("structured_data", prompt),
+            validate=is_json_object,
+            generation_config=JSON_GENERATION_CONFIG
+        )
 
-        # Extract JSON from the response
+        # Parse the JSON response
         try:
-            # First, check if the response is wrapped in code blocks
-            if "```json" in response_text and "```" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].strip()
-            else:
-                json_str = response_text.strip()
-
             # Parse the JSON
-            structured_data = json.loads(json_str)
+            structured_data = parse_gemini_json(response_text)
 
             # Add raw extraction as a field
             structured_data["raw_extraction"] = text
@@ -250,56 +853,29 @@ def categorize_document(text: str) -> Dict[str, Any]:
     Categorize a document using Gemini 2.0 Flash.
     Returns a detailed categorization with confidence scores and reasoning.
     """
+    chunks = _chunk_text(text)
+    if len(chunks) > 1:
+        return _merge_categorizations(_map_concurrently(categorize_document, chunks))
+
     try:
-        model = get_gemini_model()
+        model = get_gemini_model("categorization")
 
-        # Create a prompt for document categorization
-        prompt = f"""
-        Analyze the following document text and categorize it into the most appropriate category:
-
-        Primary categories:
-        1. "INVOICE" - Bills requesting payment for goods or services
-        2. "RECEIPT" - Proof of completed payment for goods or services
-        3. "CONTRACT" - Legal agreements between parties
-        4. "REPORT" - Information documents presenting data or findings
-        5. "CORRESPONDENCE" - Letters, emails or communication documents
-        6. "FINANCIAL" - Financial statements, reports, or records
-        7. "ID_DOCUMENT" - Identification documents like passports, licenses
-        8. "OTHER" - For documents that don't fit the above categories
-
-        Please also classify if the document is primarily related to:
-        - "INCOME" - If it's related to sales, revenue, income, or money coming in
-        - "EXPENSE" - If it's related to purchases, expenses, costs, or money going out
-        - "NEUTRAL" - If it doesn't clearly relate to income or expenses
-
-        Return only a JSON object with the following structure:
-        {{
-            "primary_category": "CATEGORY_NAME",
-            "financial_type": "INCOME, EXPENSE or NEUTRAL",
-            "confidence": number between 0-1,
-            "reasoning": "brief explanation for this categorization"
-        }}
-
-        Document text:
-        {text}
-        """
+        # Only the document text varies per call, the instructions are the model's system instruction
+        prompt = DOCUMENT_PROMPT_TEMPLATE.format(text=text)
 
-        # Generate response
-        response = model.generate_content(prompt)
-        response_text = response.text
+        # Generate response constrained to the CategorizationResult schema
+        response_text = generate_text(
+            model,
+            prompt,
+            ("categorization", prompt),
+            validate=is_json_object,
+            generation_config=CATEGORIZATION_GENERATION_CONFIG
+        )
 
-        # Try to parse the response as JSON
+        # Parse the JSON response
         try:
-            # First, check if the response is wrapped in code blocks
-            if "```json" in response_text and "```" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].strip()
-            else:
-                json_str = response_text.strip()
-
             # Parse the JSON
-            categorization_data = json.loads(json_str)
+            categorization_data = parse_gemini_json(response_text)
             return categorization_data
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse JSON from Gemini response: {e}")
@@ -322,25 +898,213 @@ def categorize_document(text: str) -> Dict[str, Any]:
         }
 
 
+def analyze_document(text: str) -> Dict[str, Any]:
+    """
+    Extract structured data, categorize and summarize a document with a single Gemini 2.0 Flash call.
+    Returns a dict with "structured_data", "categorization" and "summary" keys, shaped like
+    the results of extract_structured_data, categorize_document and summarize_document
+    respectively. Unlike extract_structured_data, the input text is not copied into
+    "raw_extraction"; callers already hold it.
+
+    Long texts are analyzed chunk by chunk in parallel; the chunk summaries are then
+    summarized once more.
+    """
+    chunks = _chunk_text(text)
+    if len(chunks) > 1:
+        results = _map_concurrently(analyze_document, chunks)
+        return {
+            "structured_data": _merge_structured_data([r["structured_data"] for r in results]),
+            "categorization": _merge_categorizations([r["categorization"] for r in results]),
+            "summary": _reduce_summaries([r["summary"] for r in results])
+        }
+
+    try:
+        model = get_gemini_model("analyze_document")
+
+        # Only the document text varies per call, the instructions are the model's system instruction
+        prompt = DOCUMENT_PROMPT_TEMPLATE.format(text=text)
+
+        # Generate response in JSON mode so no code-fence stripping is needed
+        response_text = generate_text(
+            model,
+            prompt,
+            ("analyze_document", prompt),
+            validate=is_complete_analysis,
+            generation_config=JSON_GENERATION_CONFIG
+        )
+
+        try:
+            return split_analysis(parse_gemini_json(response_text))
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Failed to parse JSON from Gemini response: {e}")
+            logger.error(f"Response text: {response_text}")
+
+            # If parsing fails, return the same categorization fallback as categorize_document
+            return {
+                "structured_data": {},
+                "categorization": {
+                    "primary_category": "UNKNOWN",
+                    "financial_type": "NEUTRAL",
+                    "confidence": 0,
+                    "reasoning": "Failed to classify document"
+                },
+                "summary": "Error generating summary."
+            }
+    except Exception as e:
+        logger.error(f"Error in Gemini API call for document analysis: {e}")
+        return {
+            "structured_data": {"error": str(e)},
+            "categorization": {
+                "primary_category": "ERROR",
+                "financial_type": "ERROR",
+                "confidence": 0,
+                "reasoning": f"Error processing document: {str(e)}"
+            },
+            "summary": "Error generating summary."
+        }
+
+
+def split_analysis(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Split a combined analysis JSON object into its structured data, categorization and summary."""
+    structured_data = result.get("structured_data")
+    if not isinstance(structured_data, dict):
+        structured_data = {}
+
+    categorization_data = {
+        key: result[key]
+        for key in ("primary_category", "financial_type", "confidence", "reasoning")
+        if key in result
+    }
+    summary = result.get("summary")
+    if not isinstance(summary, str) or not summary.strip():
+        summary = "Error generating summary."
+
+    return {"structured_data": structured_data, "categorization": categorization_data, "summary": summary.strip()}
+
+
+def analyze_documents(texts: List[str]) -> List[Dict[str, Any]]:
+    """
+    Run analyze_document for several documents with a single Gemini 2.0 Flash call.
+    Falls back to one call per document if the combined response can't be matched up.
+    """
+    if len(texts) == 1:
+        return [analyze_document(texts[0])]
+
+    try:
+        model = get_gemini_model("analyze_documents")
+
+        documents = "\n\n".join(
+            BATCH_DOCUMENT_TEMPLATE.format(number=number, text=text) for number, text in enumerate(texts, start=1)
+        )
+        prompt = BATCH_ANALYSIS_PROMPT_TEMPLATE.format(count=len(texts), documents=documents)
+
+        response = generate_with_retry(
+            model,
+            prompt,
+            generation_config=JSON_GENERATION_CONFIG
+        )
+        results = parse_gemini_json(response.text)
+
+        if not isinstance(results, list) or len(results) != len(texts):
+            raise ValueError(f"Expected {len(texts)} results, got {len(results) if isinstance(results, list) else 0}")
+
+        return [split_analysis(result) for result in results]
+    except Exception as e:
+        logger.warning(f"Batched document analysis failed, retrying per document: {e}")
+        return _map_concurrently(analyze_document, texts)
+
+
+class GeminiBatcher:
+    """
+    Collect concurrent calls of a batchable Gemini task and send them as one request.
+
+    Pending texts are flushed when max_size of them have queued up or when window
+    seconds have passed since the first one, whichever comes first. Texts longer
+    than max_chars are sent on their own so combined prompts stay small.
+    """
+
+    def __init__(self, single_fn, batch_fn, max_size: int, window: float, max_chars: int):
+        self.single_fn = single_fn
+        self.batch_fn = batch_fn
+        self.max_size = max_size
+        self.window = window
+        self.max_chars = max_chars
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._full: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def submit(self, text: str) -> Dict[str, Any]:
+        """Queue a text for the next batch and wait for its result."""
+        if self.max_size <= 1 or len(text) > self.max_chars:
+            return await asyncio.to_thread(self.single_fn, text)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+
+        if self._flusher is None:
+            self._full = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_after_window())
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+
+        return await future
+
+    async def _flush_after_window(self) -> None:
+        """Wait for the batch window (or a full batch), then send everything pending."""
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+
+        pending, self._pending = self._pending, []
+        self._flusher = None
+
+        chunks = [pending[i:i + self.max_size] for i in range(0, len(pending), self.max_size)]
+        await asyncio.gather(*(self._run(chunk) for chunk in chunks))
+
+    async def _run(self, chunk: List[Tuple[str, asyncio.Future]]) -> None:
+        """Send one batch to Gemini and resolve the waiting futures."""
+        try:
+            results = await asyncio.to_thread(self.batch_fn, [text for text, _ in chunk])
+        except Exception as e:
+            for _, future in chunk:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # A submitter may have been cancelled (e.g. client disconnect) while the batch ran
+        for (_, future), result in zip(chunk, results):
+            if not future.done():
+                future.set_result(result)
+
+
+# Micro-batches concurrent analyze_document calls from the upload endpoints
+analyze_document_batcher = GeminiBatcher(
+    analyze_document,
+    analyze_documents,
+    max_size=GEMINI_BATCH_MAX_SIZE,
+    window=GEMINI_BATCH_WINDOW,
+    max_chars=GEMINI_BATCH_MAX_CHARS
+)
+
+
 def summarize_document(text: str) -> str:
     """
     Summarize the document content using Gemini 2.0 Flash.
+    Long documents are summarized chunk by chunk, then the chunk summaries are summarized.
     """
+    chunks = _chunk_text(text)
+    if len(chunks) > 1:
+        return _reduce_summaries(_map_concurrently(summarize_document, chunks))
+
     try:
         model = get_gemini_model()
 
         # Create a prompt for document summarization
-        prompt = f"""
-        Provide a concise summary of the following document in no more than 3-5 sentences.
-        Focus on the key information and main purpose of the document.
-
-        Document text:
-        {text}
-        """
+        prompt = SUMMARY_PROMPT_TEMPLATE.format(text=text)
 
         # Generate response
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        return generate_text(model, prompt, ("summary", prompt)).strip()
     except Exception as e:
         logger.error(f"Error in document summarization: {e}")
         return "Error generating summary."
@@ -355,33 +1119,21 @@ def extract_key_value_pairs(text: str) -> Dict[str, Any]:
         model = get_gemini_model()
 
         # Create a prompt for key-value extraction
-        prompt = f"""
-        Extract all key-value pairs from this document.
-        Format the result as a JSON object where keys are the field names
-        and values are the corresponding values found in the document.
-
-        Return only a valid JSON object without any explanation or additional text.
-
-        Document text:
-        {text}
-        """
-
-        # Generate response
-        response = model.generate_content(prompt)
-        response_text = response.text
-
-        # Try to parse the response as JSON
+        prompt = KEY_VALUE_PROMPT_TEMPLATE.format(text=text)
+
+        # Generate response in JSON mode so no code-fence stripping is needed
+        response_text = generate_text(
+            model,
+            prompt,
+            ("key_value_pairs", prompt),
+            validate=is_json_object,
+            generation_config=JSON_GENERATION_CONFIG
+        )
+
+        # Parse the JSON response
         try:
-            # First, check if the response is wrapped in code blocks
-            if "```json" in response_text and "```" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].strip()
-            else:
-                json_str = response_text.strip()
-
             # Parse the JSON
-            kv_pairs = json.loads(json_str)
+            kv_pairs = parse_gemini_json(response_text)
             return kv_pairs
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse JSON from Gemini KV response: {e}")
@@ -391,41 +1143,65 @@ def extract_key_value_pairs(text: str) -> Dict[str, Any]:
         return {"error": str(e)}
 
 
-def process_batch_documents(documents: List[Tuple[bytes, str]]) -> List[Dict[str, Any]]:
+async def process_batch_documents_async(documents: List[Tuple[bytes, str]]) -> List[Dict[str, Any]]:
     """
-    Process multiple documents in batch.
-    Each document is a tuple of (file_content, filename).
+    Process multiple documents concurrently.
+    Each document is a tuple of (file_content, filename). At most GEMINI_CONCURRENCY
+    Gemini-bound steps run at once across the whole batch; results keep the input order.
+    Each distinct document costs one extraction call and each distinct extracted
+    text one analyze_document call; duplicates within the batch share the result.
     """
-    results = []
-
-    for file_content, filename in documents:
-        try:
-            # Extract text
-            extracted_text = extract_text_from_file(file_content, filename)
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    analyses: Dict[str, asyncio.Task] = {}
 
-            # Extract structured data
-            structured_data = extract_structured_data(extracted_text)
+    async def limited(fn, *args):
+        async with semaphore:
+            return await asyncio.to_thread(fn, *args)
 
-            # Categorize document
-            categorization = categorize_document(extracted_text)
+    async def process_one(file_content: bytes, filename: str) -> Dict[str, Any]:
+        try:
+            # Extract text without blocking the event loop
+            async with semaphore:
+                extracted_text = await extract_text_from_file_async(file_content, filename)
 
-            # Generate summary
-            summary = summarize_document(extracted_text)
+            # Extract structured data, categorize and summarize in a single Gemini call,
+            # shared by every document in the batch with the same text
+            if extracted_text not in analyses:
+                analyses[extracted_text] = asyncio.ensure_future(limited(analyze_document, extracted_text))
+            analysis = await analyses[extracted_text]
 
             # Combine results
-            result = {
+            return {
                 "filename": filename,
-                "extracted_data": structured_data,
-                "categorization": categorization,
-                "summary": summary
+                "extracted_data": analysis["structured_data"],
+                "categorization": analysis["categorization"],
+                "summary": analysis["summary"]
             }
-
-            results.append(result)
         except Exception as e:
             logger.error(f"Error processing document {filename}: {e}")
-            results.append({
+            return {
                 "filename": filename,
                 "error": str(e)
-            })
+            }
+
+    # Identical files (same bytes and type) are processed once
+    unique: Dict[Tuple[str, str], Tuple[bytes, str]] = {}
+    keys = []
+    for file_content, filename in documents:
+        key = (hashlib.sha256(file_content).hexdigest(), os.path.splitext(filename)[1].lower())
+        unique.setdefault(key, (file_content, filename))
+        keys.append(key)
+
+    results = await asyncio.gather(*(process_one(file_content, filename) for file_content, filename in unique.values()))
+    results_by_key = dict(zip(unique, results))
 
-    return results
+    return [{**results_by_key[key], "filename": filename} for key, (_, filename) in zip(keys, documents)]
+
+
+def process_batch_documents(documents: List[Tuple[bytes, str]]) -> List[Dict[str, Any]]:
+    """
+    Process multiple documents in batch.
+    Each document is a tuple of (file_content, filename). Synchronous wrapper around
+    process_batch_documents_async; must not be called from a running event loop.
+    """
+    return asyncio.run(process_batch_documents_async(documents))
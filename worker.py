@@ -0,0 +1,22 @@
+# worker.py
+
+import os
+from arq.connections import RedisSettings
+
+from main import process_batch_files_new
+
+
+async def process_batch(ctx, file_data, batch_id):
+    """Process a batch queued by /batch-upload; the task opens its own database sessions."""
+    await process_batch_files_new(file_data, batch_id)
+
+
+class WorkerSettings:
+    """arq worker configuration, run with `arq worker.WorkerSettings`."""
+
+    functions = [process_batch]
+    redis_settings = RedisSettings.from_dsn(os.getenv("REDIS_URL", "redis://localhost:6379"))
+    # Batches running at once per worker process; each runs up to BATCH_CONCURRENCY files in parallel
+    max_jobs = int(os.getenv("WORKER_MAX_JOBS", "5"))
+    # Large batches can take a while to get through Gemini
+    job_timeout = int(os.getenv("WORKER_JOB_TIMEOUT", "3600"))